@@ -0,0 +1,331 @@
+#Monte Carlo balance runner for rogue-like.py
+#
+#plays many seeded games with a simple scripted bot, on all CPU cores, and reports how deep the bot got, how
+#long it survived, how fast it gained experience and how long a turn took. every game runs headless in its own
+#worker process, so the games don't share any state. the tables of the game can be changed for a run with
+#--set, e.g. to try tougher trolls and slower level-ups:
+#
+#   python balance.py --games 200 --set MONSTER_STATS.troll.hp=40 --set LEVEL_UP_FACTOR=200 > balance_output.txt
+
+import os
+import sys
+import imp
+import ast
+import json
+import timeit
+import argparse
+import collections
+import multiprocessing
+
+#libtcodpy loads the library from the current directory, so run from the game's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+game = imp.load_source('roguelike', 'rogue-like.py')
+
+timer = timeit.default_timer
+
+#the bot heads for the stairs after this many turns on a level, even if it didn't explore it all
+LEVEL_TURNS = 1500
+
+#turns the bot waits for an awake monster to come to it, before it goes to the monster
+WAIT_TURNS = 3
+
+#the cumulative experience of every game is sampled every XP_SAMPLE turns
+XP_SAMPLE = 100
+
+DIRECTIONS = {(0, -1): 'up', (0, 1): 'down', (-1, 0): 'left', (1, 0): 'right', (-1, -1): 'upleft',
+    (1, -1): 'upright', (-1, 1): 'downleft', (1, 1): 'downright'}
+
+class BotInput(game.InputSource):
+    #a simple policy: drink a potion when hurt, zap or fight the monsters in view, pick up the items it saw,
+    #explore the level, then go down the stairs. it only acts when the player's turn came
+    def __init__(self, max_turns):
+        self.max_turns = max_turns
+        self.turns = 0
+        self.level_turns = 0
+        self.wanted = None #the label of the item to choose in the inventory menu
+        self.aim = None #the tile to target with a scroll
+        self.waited = 0 #turns spent waiting for a monster
+        self.level_ups = 0
+        self.depth = None
+        self.player_level = None
+        self.depths = [] #the turn each dungeon level was reached
+        self.levels = [] #the turn each character level was reached
+        self.xp_curve = []
+
+    def next_command(self):
+        state = game.state
+        if state.game_state != 'playing' or state.player.next_turn > state.game_time:
+            return None
+        if self.turns >= self.max_turns:
+            raise game.InputExhausted()
+        self.record()
+        self.turns += 1
+        self.level_turns += 1
+        return self.decide()
+
+    def record(self):
+        #keep the progress curves up to date
+        state = game.state
+        if state.dungeon_level != self.depth:
+            self.depth = state.dungeon_level
+            self.depths.append(self.turns)
+            self.level_turns = 0
+        if state.player.level != self.player_level:
+            self.player_level = state.player.level
+            self.levels.append(self.turns)
+        if self.turns % XP_SAMPLE == 0:
+            self.xp_curve.append(total_xp())
+
+    def decide(self):
+        state = game.state
+        player = state.player
+        fighter = player.fighter
+        inventory = state.inventory
+
+        if fighter.hp < fighter.max_hp // 2 and inventory.first('healing potion'):
+            return self.use('healing potion')
+
+        monsters = [obj for obj in state.objects if obj.fighter and obj is not player and game.in_fov(obj.x, obj.y)
+            and (obj.x, obj.y) != (player.x, player.y)] #a monster can stand where the player arrived
+        if monsters:
+            monster = min(monsters, key = player.distance_to)
+            distance = player.distance_to(monster)
+            if distance < 2:
+                return DIRECTIONS[(monster.x - player.x, monster.y - player.y)]
+            if distance <= game.LIGHTNING_RANGE and inventory.first('scroll of lightning bolt'):
+                return self.use('scroll of lightning bolt')
+            if distance > game.FIREBALL_RADIUS and inventory.first('scroll of fireball'):
+                self.aim = (monster.x, monster.y)
+                return self.use('scroll of fireball')
+            if monster.name == 'troll' and distance <= game.CONFUSE_RANGE and inventory.first('scroll of confusion'):
+                self.aim = (monster.x, monster.y)
+                return self.use('scroll of confusion')
+            if not monster.asleep and self.waited < WAIT_TURNS:
+                self.waited += 1
+                return 'wait' #let it come, so it doesn't get the first blow
+            self.waited = 0
+            step = first_step(lambda i: i == tile_index(monster))
+            if step:
+                return DIRECTIONS[step]
+
+        room = len(inventory) < 26
+        items = set()
+        if room:
+            items = set(tile_index(obj) for obj in state.objects if obj.item)
+        if tile_index(player) in items:
+            return 'g'
+
+        if self.level_turns < LEVEL_TURNS:
+            #go to the closest item or unexplored place
+            blocked = state.map.blocked.tolist()
+            explored = state.map.explored.tolist()
+            offsets = neighbour_offsets()
+            def is_goal(i):
+                if i in items:
+                    return True
+                for offset in offsets:
+                    if not explored[i + offset] and not blocked[i + offset]:
+                        return True
+                return False
+            step = first_step(is_goal, blocked, explored)
+            if step:
+                return DIRECTIONS[step]
+
+        stairs = state.stairs
+        if (player.x, player.y) == (stairs.x, stairs.y):
+            return 's'
+        step = first_step(lambda i: i == tile_index(stairs))
+        if step:
+            return DIRECTIONS[step]
+        return 'wait'
+
+    def use(self, label):
+        self.wanted = label
+        return 'i'
+
+    def choose(self, header, options):
+        if 'LEVEL UP' in header:
+            #raise constitution, strength and agility in turn
+            self.level_ups += 1
+            return (self.level_ups - 1) % 3
+        if self.wanted is not None:
+            label = self.wanted
+            self.wanted = None
+            for (i, text) in enumerate(options):
+                if text == label or text.startswith(label + ' ('):
+                    return i
+        return None
+
+    def target(self, max_range = None):
+        #aim once, then cancel if the tile wasn't good (target_monster asks again)
+        aim = self.aim
+        self.aim = None
+        if aim is None or not game.in_fov(*aim):
+            return (None, None)
+        if max_range is None or game.state.player.distance(*aim) <= max_range:
+            return aim
+        return (None, None)
+
+def total_xp():
+    #the experience gained since the start, including the experience spent on level-ups
+    player = game.state.player
+    spent = sum(game.LEVEL_UP_BASE + level * game.LEVEL_UP_FACTOR for level in range(1, player.level))
+    return spent + player.fighter.xp
+
+def tile_index(obj):
+    return obj.y * game.state.map.width + obj.x
+
+def neighbour_offsets():
+    #the differences between the index of a tile and the indexes of its neighbours, in game.NEIGHBOURS order
+    return [dy * game.state.map.width + dx for (dx, dy) in game.NEIGHBOURS]
+
+def first_step(goal, blocked = None, explored = None):
+    #the first step of the shortest path to the closest explored tile for which goal(index) is true, through
+    #explored floor tiles, or None if there is none. the border of the map is always wall, so the neighbours of
+    #a floor tile are always on the map
+    if blocked is None:
+        blocked = game.state.map.blocked.tolist()
+        explored = game.state.map.explored.tolist()
+    moves = list(zip(neighbour_offsets(), game.NEIGHBOURS))
+    start = tile_index(game.state.player)
+    steps = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        i = queue.popleft()
+        first = steps[i]
+        for (offset, step) in moves:
+            j = i + offset
+            if j in steps or blocked[j] or not explored[j]:
+                continue
+            steps[j] = first or step
+            if goal(j):
+                return steps[j]
+            queue.append(j)
+    return None
+
+def parse_setting(text):
+    #'NAME=VALUE' or 'NAME.key.key=VALUE', the value being a Python literal
+    (path, value) = text.split('=', 1)
+    return (path.split('.'), ast.literal_eval(value))
+
+def apply_settings(settings):
+    #change the game's constants, in a worker process
+    for (path, value) in settings:
+        if len(path) == 1:
+            setattr(game, path[0], value)
+            continue
+        table = getattr(game, path[0])
+        for key in path[1:-1]:
+            table = table[key]
+        table[path[-1]] = value
+
+def play_seed(task):
+    #play one game with the bot, returns its results
+    (seed, max_turns) = task
+    game.record_games = False
+    game.set_seed(seed)
+    bot = BotInput(max_turns)
+    start = timer()
+    summary = game.run_headless(bot, None)
+    seconds = timer() - start
+    return {'seed': seed, 'state': summary['game_state'], 'depth': summary['dungeon_level'],
+        'player_level': summary['player_level'], 'turns': bot.turns, 'ticks': game.state.game_time, 'xp': total_xp(),
+        'frames': summary['frames'], 'seconds': seconds, 'depths': bot.depths, 'levels': bot.levels, 'xp_curve': bot.xp_curve}
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+def mean(values):
+    if not values:
+        return None
+    return float(sum(values)) / len(values)
+
+def summarize(results):
+    #aggregate the results of all the games
+    deaths = collections.Counter(result['depth'] for result in results if result['state'] == 'dead')
+    turns = sum(result['turns'] for result in results)
+    summary = {'games': len(results), 'died': sum(deaths.values()),
+        'depth': {'mean': mean([result['depth'] for result in results]),
+            'median': median([result['depth'] for result in results]),
+            'max': max(result['depth'] for result in results)},
+        'turns': {'mean': mean([result['turns'] for result in results]),
+            'median': median([result['turns'] for result in results])},
+        'xp': {'mean': mean([result['xp'] for result in results]),
+            'median': median([result['xp'] for result in results])},
+        'deaths_by_depth': dict(deaths),
+        'ms_per_turn': 1000.0 * sum(result['seconds'] for result in results) / max(turns, 1)}
+
+    #the median turn each dungeon level and character level was reached on, by the games that got there
+    for key in ['depths', 'levels']:
+        curve = []
+        for i in range(max(len(result[key]) for result in results)):
+            reached = [result[key][i] for result in results if len(result[key]) > i]
+            curve.append({'level': i + 1, 'games': len(reached), 'median_turn': median(reached)})
+        summary[key] = curve
+
+    #the mean cumulative experience every XP_SAMPLE turns, of the games still going
+    curve = []
+    for i in range(max(len(result['xp_curve']) for result in results)):
+        samples = [result['xp_curve'][i] for result in results if len(result['xp_curve']) > i]
+        curve.append({'turn': i * XP_SAMPLE, 'games': len(samples), 'mean_xp': mean(samples)})
+    summary['xp_curve'] = curve
+    return summary
+
+def print_report(summary, seconds):
+    print('games: %d, died: %d, %.1f seconds, %.3f ms per turn' % (summary['games'], summary['died'], seconds,
+        summary['ms_per_turn']))
+    for key in ['depth', 'turns', 'xp']:
+        values = summary[key]
+        print('%s: %s' % (key, ', '.join('%s %s' % (name, round(values[name], 1)) for name in sorted(values))))
+    print('deaths by depth: %s' % ', '.join('%d: %d' % item for item in sorted(summary['deaths_by_depth'].items())))
+    print('')
+    print('dungeon level  games  median turn')
+    for row in summary['depths']:
+        print('%13d  %5d  %11d' % (row['level'], row['games'], row['median_turn']))
+    print('')
+    print('player level   games  median turn')
+    for row in summary['levels']:
+        print('%13d  %5d  %11d' % (row['level'], row['games'], row['median_turn']))
+    print('')
+    print('turn   games  mean xp')
+    for row in summary['xp_curve']:
+        print('%5d  %5d  %7.1f' % (row['turn'], row['games'], row['mean_xp']))
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Play many games of rogue-like.py with a bot and report how they went.')
+    parser.add_argument('--games', type = int, default = 100)
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the first game, the others follow')
+    parser.add_argument('--max-turns', type = int, default = 5000, help = 'turns after which a game is stopped')
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (default: one per CPU)')
+    parser.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE',
+        help = 'change a constant of the game, e.g. LEVEL_UP_BASE=250 or MONSTER_STATS.orc.hp=25')
+    parser.add_argument('--json', default = None, help = 'also write the results of every game to this file')
+    args = parser.parse_args()
+
+    settings = [parse_setting(text) for text in args.set]
+    tasks = [(args.seed + i, args.max_turns) for i in range(args.games)]
+    start = timer()
+    pool = multiprocessing.Pool(args.workers, apply_settings, (settings,))
+    try:
+        results = sorted(pool.imap_unordered(play_seed, tasks), key = lambda result: result['seed'])
+    finally:
+        pool.close()
+        pool.join()
+    seconds = timer() - start
+
+    summary = summarize(results)
+    print_report(summary, seconds)
+    if args.json:
+        output = open(args.json, 'w')
+        json.dump({'settings': args.set, 'python': sys.version.split()[0], 'summary': summary, 'games': results},
+            output, sort_keys = True)
+        output.close()
+
+if __name__ == '__main__':
+    main()
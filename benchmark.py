@@ -0,0 +1,193 @@
+#benchmarks for the hot paths of rogue-like.py
+#
+#every workload uses a fixed seed, and can be scaled by map size and object count. results are printed
+#as JSON, one object per line, so runs of different builds can be saved and compared:
+#
+#   python benchmark.py --sizes 80x38,160x76 --objects 100,1000 > bench_output.txt
+
+import os
+import sys
+import imp
+import json
+import random
+import timeit
+import tempfile
+import argparse
+
+#libtcodpy loads the library from the current directory, so run from the game's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import libtcodpy as libtcod
+
+game = imp.load_source('roguelike', 'rogue-like.py')
+
+timer = timeit.default_timer
+
+def measure(function, repeat):
+    #run a function several times and return the timings, in seconds
+    timings = []
+    for i in range(repeat):
+        start = timer()
+        function()
+        timings.append(timer() - start)
+    return timings
+
+def setup_game(width, height, seed):
+    #start a new game on a map of the given size, with consoles to render into but no window
+    game.MAP_WIDTH = width
+    game.MAP_HEIGHT = height
+    game.MAX_ROOMS = max(1, 30 * width * height // (80 * 38)) #keep the room density of a normal map
+    game.set_seed(seed)
+    game.con = libtcod.console_new(width, height)
+    game.panel = libtcod.console_new(game.SCREEN_WIDTH, game.PANEL_HEIGHT)
+    game.new_game()
+    game.state.level_cache.wait() #don't time the next level being generated in the background
+
+def floor_tiles(rnd, count):
+    #pick random unblocked tiles of the current map
+    tiles = [(x, y) for y in range(game.state.map.height) for x in range(game.state.map.width)
+        if not game.is_blocked(x, y)]
+    return [rnd.choice(tiles) for i in range(count)]
+
+def add_monsters(rnd, count):
+    #crowd the current level with orcs
+    for (x, y) in floor_tiles(rnd, count):
+        fighter_component = game.Fighter(hp = 20, defense = 0, power = 4, xp = 35, death_function = game.monster_death)
+        monster = game.Object(x, y, game.orc_tile, 'orc', libtcod.white,
+            blocks = True, fighter = fighter_component, ai = game.BasicMonster())
+        game.add_object(monster)
+
+def bench_make_map(width, height, objects, seed, repeat):
+    setup_game(width, height, seed)
+    game.set_seed(seed)
+    return measure(game.make_map, repeat), {}
+
+def bench_initialize_fov(width, height, objects, seed, repeat):
+    setup_game(width, height, seed)
+    return measure(game.initialize_fov, repeat), {}
+
+def bench_fov_recompute(width, height, objects, seed, repeat):
+    #recompute the FOV and repaint the map, as render_all does after every player move
+    setup_game(width, height, seed)
+    add_monsters(random.Random(seed), objects)
+    game.render_map()
+    def recompute():
+        game.state.fov_recompute = True
+        game.render_map()
+    return measure(recompute, repeat), {}
+
+def bench_full_repaint(width, height, objects, seed, repeat):
+    #repaint every map cell and object, as after a level change
+    setup_game(width, height, seed)
+    add_monsters(random.Random(seed), objects)
+    def repaint():
+        game.redraw_map()
+        game.state.fov_recompute = True
+        game.render_map()
+    return measure(repaint, repeat), {}
+
+def bench_is_blocked(width, height, objects, seed, repeat):
+    #10000 is_blocked queries on a level crowded with monsters
+    setup_game(width, height, seed)
+    rnd = random.Random(seed)
+    add_monsters(rnd, objects)
+    queries = [(rnd.randrange(width), rnd.randrange(height)) for i in range(10000)]
+    def query():
+        is_blocked = game.state.is_blocked
+        for (x, y) in queries:
+            is_blocked(x, y)
+    return measure(query, repeat), {'queries': len(queries)}
+
+def bench_monster_turns(width, height, objects, seed, repeat):
+    #one turn of every monster, as in play_game
+    setup_game(width, height, seed)
+    add_monsters(random.Random(seed), objects)
+    game.update_fov()
+    #keep the player alive through all the attacks (in god mode the monsters would neither chase nor attack)
+    fighter = game.state.player.fighter
+    fighter.base_max_hp = fighter.hp = 10 ** 9
+    scans = game.state.inventory_scans
+    def sweep():
+        for object in game.state.objects:
+            if object.ai:
+                object.ai.take_turn()
+    timings = measure(sweep, repeat)
+    return timings, {'inventory_scans': game.state.inventory_scans - scans, 'damage': 10 ** 9 - fighter.hp}
+
+def bench_game_ticks(width, height, objects, seed, repeat):
+    #100 ticks of game time, as in play_game while the player stands still
+    setup_game(width, height, seed)
+    add_monsters(random.Random(seed), objects)
+    game.schedule_level()
+    game.update_fov()
+    def ticks():
+        for i in range(100):
+            game.advance_time(1)
+    timings = measure(ticks, repeat)
+    awake = sum(1 for obj in game.state.objects if obj.ai and not obj.asleep)
+    return timings, {'awake': awake}
+
+def bench_save_load(width, height, objects, seed, repeat):
+    #save the game and load it back
+    setup_game(width, height, seed)
+    add_monsters(random.Random(seed), objects)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'savegame')
+    def round_trip():
+        game.save_game(filename)
+        game.load_game(filename)
+    timings = measure(round_trip, repeat)
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return timings, {'file_size': size}
+
+BENCHMARKS = [
+    ('make_map', bench_make_map),
+    ('initialize_fov', bench_initialize_fov),
+    ('fov_recompute', bench_fov_recompute),
+    ('full_repaint', bench_full_repaint),
+    ('is_blocked', bench_is_blocked),
+    ('monster_turns', bench_monster_turns),
+    ('game_ticks', bench_game_ticks),
+    ('save_load', bench_save_load),
+    ]
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split('x')) for size in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the hot paths of rogue-like.py.')
+    parser.add_argument('--sizes', default = '80x38', help = 'comma separated map sizes, e.g. 80x38,160x76')
+    parser.add_argument('--objects', default = '100', help = 'comma separated numbers of extra monsters')
+    parser.add_argument('--seed', type = int, default = 1234)
+    parser.add_argument('--repeat', type = int, default = 10)
+    parser.add_argument('--only', default = None, help = 'comma separated benchmark names')
+    args = parser.parse_args()
+
+    #the consoles need a font, even though nothing is shown
+    libtcod.console_set_custom_font('tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
+    libtcod.console_map_ascii_codes_to_font(256, 32, 0, 5)
+    libtcod.console_map_ascii_codes_to_font(256+32, 32, 0, 6)
+    game.headless = True
+
+    only = args.only.split(',') if args.only else None
+    for (width, height) in parse_sizes(args.sizes):
+        for objects in [int(n) for n in args.objects.split(',')]:
+            for (name, benchmark) in BENCHMARKS:
+                if only and name not in only:
+                    continue
+                (timings, extra) = benchmark(width, height, objects, args.seed, args.repeat)
+                timings.sort()
+                result = {'benchmark': name, 'map': '%dx%d' % (width, height), 'objects': objects,
+                    'seed': args.seed, 'repeat': args.repeat, 'best': timings[0],
+                    'median': timings[len(timings) // 2], 'python': sys.version.split()[0],
+                    'numpy': libtcod.numpy_available}
+                result.update(extra)
+                print(json.dumps(result, sort_keys = True))
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
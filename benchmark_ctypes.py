@@ -0,0 +1,165 @@
+#microbenchmark of the libtcod calls made most often by rogue-like.py
+#
+#every function is timed three ways, in calls per second:
+#   untyped: a python wrapper around the C function without prototypes, as libtcodpy used to call it on
+#            linux and windows (ctypes guesses the argument types, pointers and bools are wrapped by hand)
+#   typed:   a python wrapper around the C function with the prototypes of cprotos.py, as libtcodpy used
+#            to call it on mac
+#   after:   libtcodpy as it is now (prototypes everywhere, except for the functions called per cell, per
+#            object or per frame, whose wrappers wrap the handle by hand)
+#the three ways take turns in every repeat, so that a change of the machine's speed during a run affects
+#them all alike, and the best of the repeats is kept
+#results are printed as JSON, one object per line:
+#
+#   python benchmark_ctypes.py --calls 100000 > ctypes_output.txt
+
+import os
+import sys
+import json
+import inspect
+import timeit
+import argparse
+from ctypes import CDLL, c_void_p, c_int, c_float, c_bool, c_uint
+
+#libtcodpy loads the library from the current directory, so run from the game's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import libtcodpy as libtcod
+from cprotos import setup_protos
+
+timer = timeit.default_timer
+
+#functions returning something else than an int, which libtcodpy declared even without prototypes
+RESTYPES = {
+    'map_is_in_fov': c_bool,
+    'map_is_walkable': c_bool,
+    'map_is_transparent': c_bool,
+    'path_compute': c_bool,
+    'dijkstra_get_distance': c_float,
+    'sys_elapsed_milli': c_uint,
+    }
+
+def untyped_library():
+    #a second handle on the library, without any prototype set
+    if sys.platform.find('linux') != -1:
+        return CDLL('./libtcod.so')
+    elif sys.platform.find('darwin') != -1:
+        return CDLL('./libtcod.dylib')
+    return CDLL('./libtcod-mingw.dll')
+
+def typed_library():
+    #a third handle on the library, with all the prototypes of cprotos.py
+    lib = untyped_library()
+    setup_protos(lib)
+    return lib
+
+class ByHand:
+    #an argument converted to a ctypes type on every call, as the libtcodpy wrappers do
+    def __init__(self, ctype, value):
+        self.ctype = ctype
+        self.value = value
+
+def python_wrapper(function, args):
+    #the extra python call of a libtcodpy wrapper, converting the ByHand arguments. returns the wrapper
+    #and the arguments to call it with
+    names = ['a%d' % i for i in range(len(args))]
+    passed = [('t%d(%s)' % (i, name) if isinstance(arg, ByHand) else name)
+        for (i, (name, arg)) in enumerate(zip(names, args))]
+    namespace = dict(('t%d' % i, arg.ctype) for (i, arg) in enumerate(args) if isinstance(arg, ByHand))
+    namespace['function'] = function
+    exec('def wrapper(%s):\n    return function(%s)\n' % (', '.join(names), ', '.join(passed)), namespace)
+    return (namespace['wrapper'], tuple((arg.value if isinstance(arg, ByHand) else arg) for arg in args))
+
+def measure(function, args, calls):
+    #number of calls per second of a function
+    loop = range(calls)
+    start = timer()
+    for i in loop:
+        function(*args)
+    return calls / (timer() - start)
+
+def workloads(con, con2, fov_map, path, dijkstra):
+    #(name, untyped arguments, typed arguments, libtcodpy arguments) for the 20 functions called most often
+    #by the game. without prototypes pointers have to be wrapped or they are truncated to 32 bits, and bools
+    #and floats have to be converted by hand, on every call
+    old_con = ByHand(c_void_p, con)
+    old_con2 = ByHand(c_void_p, con2)
+    old_map = ByHand(c_void_p, fov_map)
+    color = libtcod.light_blue
+    text = 'Hello world'
+    return [
+        ('console_put_char_ex', (old_con, 1, 1, 64, color, color), (con, 1, 1, 64, color, color), None),
+        ('console_put_char', (old_con, 1, 1, 64, libtcod.BKGND_NONE), (con, 1, 1, 64, libtcod.BKGND_NONE), None),
+        ('console_set_char', (old_con, 1, 1, 64), (con, 1, 1, 64), None),
+        ('console_set_char_background', (old_con, 1, 1, color, libtcod.BKGND_SET),
+            (con, 1, 1, color, libtcod.BKGND_SET), None),
+        ('console_set_char_foreground', (old_con, 1, 1, color), (con, 1, 1, color), None),
+        ('console_set_default_foreground', (old_con, color), (con, color), None),
+        ('console_set_default_background', (old_con, color), (con, color), None),
+        #the print functions are variadic, so they stay without prototype
+        ('console_print_ex', (old_con, 1, 1, libtcod.BKGND_NONE, libtcod.LEFT, text),
+            (old_con, 1, 1, libtcod.BKGND_NONE, libtcod.LEFT, text), (con, 1, 1, libtcod.BKGND_NONE, libtcod.LEFT, text)),
+        ('console_get_height_rect', (old_con, 0, 0, 20, 0, text), (old_con, 0, 0, 20, 0, text), (con, 0, 0, 20, 0, text)),
+        ('console_rect', (old_con, 0, 0, 10, 1, ByHand(c_int, False), libtcod.BKGND_SCREEN),
+            (con, 0, 0, 10, 1, False, libtcod.BKGND_SCREEN), None),
+        ('console_clear', (old_con2,), (con2,), None),
+        ('console_blit', (old_con2, 0, 0, 10, 10, old_con, 0, 0, ByHand(c_float, 1.0), ByHand(c_float, 1.0)),
+            (con2, 0, 0, 10, 10, con, 0, 0, 1.0, 1.0), None),
+        ('map_is_in_fov', (old_map, 5, 5), (fov_map, 5, 5), None),
+        ('map_is_walkable', (old_map, 5, 5), (fov_map, 5, 5), None),
+        ('map_is_transparent', (old_map, 5, 5), (fov_map, 5, 5), None),
+        ('map_set_properties', (old_map, 5, 5, ByHand(c_int, True), ByHand(c_int, True)), (fov_map, 5, 5, True, True), None),
+        ('map_compute_fov', (old_map, 5, 5, 10, ByHand(c_int, True), 0), (fov_map, 5, 5, 10, True, 0), None),
+        ('path_compute', (ByHand(c_void_p, path[0]), 1, 1, 8, 8), (path[0], 1, 1, 8, 8), (path, 1, 1, 8, 8)),
+        ('dijkstra_get_distance', (ByHand(c_void_p, dijkstra[0]), ByHand(c_int, 8), ByHand(c_int, 8)), (dijkstra[0], 8, 8), (dijkstra, 8, 8)),
+        ('random_get_int', (ByHand(c_void_p, 0), 0, 100), (0, 0, 100), None),
+        ('sys_elapsed_milli', (), (), None),
+        ]
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the libtcod calls made by rogue-like.py.')
+    parser.add_argument('--calls', type = int, default = 100000, help = 'calls per function and run')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--only', default = None, help = 'comma separated function names')
+    args = parser.parse_args()
+
+    #the consoles need a font, even though nothing is shown
+    libtcod.console_set_custom_font('tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
+    con = libtcod.console_new(80, 50)
+    con2 = libtcod.console_new(10, 10)
+    fov_map = libtcod.map_new(10, 10)
+    libtcod.map_clear(fov_map, True, True)
+    path = libtcod.path_new_using_map(fov_map)
+    dijkstra = libtcod.dijkstra_new(fov_map)
+    libtcod.dijkstra_compute(dijkstra, 1, 1)
+
+    old = untyped_library()
+    protos = typed_library()
+    only = args.only.split(',') if args.only else None
+    for (name, untyped_args, typed_args, libtcodpy_args) in workloads(con, con2, fov_map, path, dijkstra):
+        if only and name not in only:
+            continue
+        untyped = getattr(old, 'TCOD_' + name)
+        if name in RESTYPES:
+            untyped.restype = RESTYPES[name]
+        typed = getattr(protos, 'TCOD_' + name)
+        after = getattr(libtcod, name)
+        libtcod_function = getattr(libtcod._lib, 'TCOD_' + name)
+        ways = [
+            ('untyped',) + python_wrapper(untyped, untyped_args),
+            ('typed',) + python_wrapper(typed, typed_args),
+            ('after', after, libtcodpy_args or typed_args),
+            ]
+        result = {'function': name, 'calls': args.calls, 'repeat': args.repeat,
+            'fast_path': not inspect.isfunction(after), 'prototype': libtcod_function.argtypes is not None,
+            'python': sys.version.split()[0]}
+        for i in range(args.repeat):
+            for (way, function, call_args) in ways:
+                result[way] = int(max(result.get(way, 0), measure(function, call_args, args.calls)))
+        result['speedup'] = round(float(result['after']) / result['untyped'], 2)
+        print(json.dumps(result, sort_keys = True))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -507,7 +507,7 @@ def setup_protos(lib):
     lib.TCOD_image_blit.argtypes=[c_void_p , c_void_p , c_float , c_float , ]
 
     lib.TCOD_image_blit_rect.restype=c_void
-    lib.TCOD_image_blit_rect.argtypes=[c_void_p , c_void_p , c_int, c_int, c_int, c_int, ]
+    lib.TCOD_image_blit_rect.argtypes=[c_void_p , c_void_p , c_int, c_int, c_int, c_int, c_int ]
 
     lib.TCOD_image_blit_2x.restype=c_void
     lib.TCOD_image_blit_2x.argtypes=[c_void_p , c_void_p , c_int, c_int, c_int, c_int, c_int, c_int]
@@ -657,7 +657,7 @@ def setup_protos(lib):
     lib.TCOD_random_restore.argtypes=[c_void_p , c_void_p ]
 
     lib.TCOD_random_new_from_seed.restype=c_void_p
-    lib.TCOD_random_new_from_seed.argtypes=[c_int , c_int ]
+    lib.TCOD_random_new_from_seed.argtypes=[c_int , c_uint ]
 
     lib.TCOD_random_delete.restype=c_void
     lib.TCOD_random_delete.argtypes=[c_void_p ]
@@ -921,7 +921,7 @@ def setup_protos(lib):
     lib.TCOD_sys_elapsed_seconds.argtypes=[]
 
     lib.TCOD_sys_sleep_milli.restype=c_void
-    lib.TCOD_sys_sleep_milli.argtypes=[c_int ]
+    lib.TCOD_sys_sleep_milli.argtypes=[c_uint ]
 
     lib.TCOD_sys_save_screenshot.restype=c_void
     lib.TCOD_sys_save_screenshot.argtypes=[c_char_p]
@@ -85,8 +85,16 @@ class Color(Structure):
                 ('b', c_uint8),
                 ]
 
+    # compared in python, as python 2 does not derive != from ==
     def __eq__(self, c):
-        return _lib.TCOD_color_equals(self, c)
+        if not isinstance(c, Color):
+            return NotImplemented
+        return self.r == c.r and self.g == c.g and self.b == c.b
+
+    def __ne__(self, c):
+        if not isinstance(c, Color):
+            return NotImplemented
+        return self.r != c.r or self.g != c.g or self.b != c.b
 
     def __mul__(self, c):
         if isinstance(c,Color):
@@ -120,10 +128,30 @@ class Color(Structure):
         yield self.g
         yield self.b
 
-# Should be valid on any platform, check it!  Has to be done after Color is defined.
-if MAC:
-    from cprotos import setup_protos
-    setup_protos(_lib)
+# argument and return types of all the functions, so that ctypes doesn't have
+# to guess them on every call (and pointers aren't truncated on 64 bits
+# systems). Has to be done after Color is defined.
+from cprotos import setup_protos
+setup_protos(_lib)
+if MINGW or MSVC:
+    # the _wrapper functions take colors packed in an int, keep them untyped
+    for _name in ['TCOD_color_multiply', 'TCOD_color_add', 'TCOD_color_multiply_scalar',
+                  'TCOD_color_subtract', 'TCOD_color_lerp', 'TCOD_image_get_pixel',
+                  'TCOD_image_get_mipmap_pixel', 'TCOD_parser_get_color_property',
+                  'TCOD_console_get_default_background', 'TCOD_console_get_default_foreground',
+                  'TCOD_console_get_char_background', 'TCOD_console_get_char_foreground',
+                  'TCOD_console_get_fading_color']:
+        getattr(_lib, _name).argtypes = None
+# every typed argument costs a converter call. the functions called per cell,
+# per object or per frame with ints besides the handle stay untyped (the
+# restype is kept), and their wrappers convert the handle and any float by hand
+for _name in ['TCOD_console_put_char', 'TCOD_console_put_char_ex', 'TCOD_console_set_char_background',
+              'TCOD_console_set_char_foreground', 'TCOD_console_set_char',
+              'TCOD_console_get_char', 'TCOD_console_rect', 'TCOD_console_blit', 'TCOD_random_get_int',
+              'TCOD_map_set_properties', 'TCOD_map_is_in_fov', 'TCOD_map_is_transparent',
+              'TCOD_map_is_walkable', 'TCOD_map_compute_fov', 'TCOD_path_compute',
+              'TCOD_dijkstra_get_distance']:
+    getattr(_lib, _name).argtypes = None
 
 _lib.TCOD_color_equals.restype = c_bool
 _lib.TCOD_color_multiply.restype = Color
@@ -355,8 +383,28 @@ peach=Color(255,159,127)
 
 # color functions
 _lib.TCOD_color_lerp.restype = Color
+# c1 and c2 can also be numpy arrays of colors (shape (..., 3)) and a a numpy
+# array of coefficients, to lerp whole maps at once. the result is then a
+# uint8 array of colors. lists of colors and coefficients give a list of
+# colors. a single color or coefficient is used for every element
 def color_lerp(c1, c2, a):
-    return _lib.TCOD_color_lerp(c1, c2, c_float(a))
+    if isinstance(c1, Color) and isinstance(c2, Color) and not hasattr(a, '__len__'):
+        return _lib.TCOD_color_lerp(c1, c2, c_float(a))
+    if (numpy_available and (isinstance(c1, numpy.ndarray) or isinstance(c2, numpy.ndarray) or
+                             isinstance(a, numpy.ndarray))):
+        # single precision floats, truncated and wrapped to a byte like in C
+        c1 = numpy.asarray(tuple(c1) if isinstance(c1, Color) else c1, dtype=numpy.float32)
+        c2 = numpy.asarray(tuple(c2) if isinstance(c2, Color) else c2, dtype=numpy.float32)
+        a = numpy.asarray(a, dtype=numpy.float32)[..., numpy.newaxis]
+        return ((c1 + (c2 - c1) * a).astype(numpy.int32) & 255).astype(numpy.uint8)
+    n = max(len(x) for x in (c1, c2, a) if hasattr(x, '__len__'))
+    if isinstance(c1, Color):
+        c1 = [c1] * n
+    if isinstance(c2, Color):
+        c2 = [c2] * n
+    if not hasattr(a, '__len__'):
+        a = [a] * n
+    return [_lib.TCOD_color_lerp(x1, x2, c_float(x)) for (x1, x2, x) in zip(c1, c2, a)]
 
 def color_set_hsv(c, h, s, v):
     _lib.TCOD_color_set_HSV(byref(c), c_float(h), c_float(s), c_float(v))
@@ -655,7 +703,7 @@ RIGHT=1
 CENTER=2
 # initializing the console
 def console_init_root(w, h, title, fullscreen=False, renderer=RENDERER_GLSL):
-    _lib.TCOD_console_init_root(w, h, title, c_uint(fullscreen), c_uint(renderer))
+    _lib.TCOD_console_init_root(w, h, title, c_bool(fullscreen), c_uint(renderer))
 
 def console_get_width(con):
     return _lib.TCOD_console_get_width(con)
@@ -690,7 +738,7 @@ def console_is_fullscreen():
     return _lib.TCOD_console_is_fullscreen()
 
 def console_set_fullscreen(fullscreen):
-    _lib.TCOD_console_set_fullscreen(c_int(fullscreen))
+    _lib.TCOD_console_set_fullscreen(c_bool(fullscreen))
 
 def console_is_window_closed():
     return _lib.TCOD_console_is_window_closed()
@@ -705,7 +753,7 @@ def console_credits_reset():
     _lib.TCOD_console_credits_reset()
 
 def console_credits_render(x, y, alpha):
-    return _lib.TCOD_console_credits_render(x, y, c_int(alpha))
+    return _lib.TCOD_console_credits_render(x, y, c_bool(alpha))
 
 def console_flush():
     _lib.TCOD_console_flush()
@@ -722,27 +770,27 @@ def console_clear(con):
 
 def console_put_char(con, x, y, c, flag=BKGND_DEFAULT):
     if type(c) == str:
-        _lib.TCOD_console_put_char(con, x, y, ord(c), flag)
+        _lib.TCOD_console_put_char(c_void_p(con), x, y, ord(c), flag)
     else:
-        _lib.TCOD_console_put_char(con, x, y, c, flag)
+        _lib.TCOD_console_put_char(c_void_p(con), x, y, c, flag)
 
 def console_put_char_ex(con, x, y, c, fore, back):
     if type(c) == str:
-        _lib.TCOD_console_put_char_ex(con, x, y, ord(c), fore, back)
+        _lib.TCOD_console_put_char_ex(c_void_p(con), x, y, ord(c), fore, back)
     else:
-        _lib.TCOD_console_put_char_ex(con, x, y, c, fore, back)
+        _lib.TCOD_console_put_char_ex(c_void_p(con), x, y, c, fore, back)
 
 def console_set_char_background(con, x, y, col, flag=BKGND_SET):
-    _lib.TCOD_console_set_char_background(con, x, y, col, flag)
+    _lib.TCOD_console_set_char_background(c_void_p(con), x, y, col, flag)
 
 def console_set_char_foreground(con, x, y, col):
-    _lib.TCOD_console_set_char_foreground(con, x, y, col)
+    _lib.TCOD_console_set_char_foreground(c_void_p(con), x, y, col)
 
 def console_set_char(con, x, y, c):
     if type(c) == str:
-        _lib.TCOD_console_set_char(con, x, y, ord(c))
+        _lib.TCOD_console_set_char(c_void_p(con), x, y, ord(c))
     else:
-        _lib.TCOD_console_set_char(con, x, y, c)
+        _lib.TCOD_console_set_char(c_void_p(con), x, y, c)
 
 def console_set_background_flag(con, flag):
     _lib.TCOD_console_set_background_flag(con, c_int(flag))
@@ -772,7 +820,7 @@ def console_get_height_rect(con, x, y, w, h, fmt):
     return _lib.TCOD_console_get_height_rect(c_void_p(con), x, y, w, h, c_char_p(fmt))
 
 def console_rect(con, x, y, w, h, clr, flag=BKGND_DEFAULT):
-    _lib.TCOD_console_rect(con, x, y, w, h, c_int(clr), flag)
+    _lib.TCOD_console_rect(c_void_p(con), x, y, w, h, clr, flag)
 
 def console_hline(con, x, y, l, flag=BKGND_DEFAULT):
     _lib.TCOD_console_hline( con, x, y, l, flag)
@@ -799,7 +847,7 @@ def console_get_char_foreground(con, x, y):
     return _lib.TCOD_console_get_char_foreground(con, x, y)
 
 def console_get_char(con, x, y):
-    return _lib.TCOD_console_get_char(con, x, y)
+    return _lib.TCOD_console_get_char(c_void_p(con), x, y)
 
 def console_set_fade(fade, fadingColor):
     _lib.TCOD_console_set_fade(fade, fadingColor)
@@ -843,7 +891,7 @@ def console_get_height(con):
     return _lib.TCOD_console_get_height(con)
 
 def console_blit(src, x, y, w, h, dst, xdst, ydst, ffade=1.0,bfade=1.0):
-    _lib.TCOD_console_blit(src, x, y, w, h, dst, xdst, ydst, c_float(ffade), c_float(bfade))
+    _lib.TCOD_console_blit(c_void_p(src), x, y, w, h, c_void_p(dst), xdst, ydst, c_float(ffade), c_float(bfade))
 
 def console_set_key_color(con, col):
     _lib.TCOD_console_set_key_color(con, col)
@@ -859,9 +907,9 @@ def console_fill_foreground(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -880,9 +928,9 @@ def console_fill_background(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -897,11 +945,11 @@ def console_fill_background(con,r,g,b) :
 def console_fill_char(con,arr) :
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
-        #otherwise convert using the struct module
-        carr = struct.pack('%di' % len(arr), *arr)
+        #otherwise convert using ctypes arrays
+        carr = (c_int * len(arr))(*arr)
 
     _lib.TCOD_console_fill_char(con, carr)
         
@@ -1127,7 +1175,7 @@ class Mouse(Structure):
 _lib.TCOD_mouse_is_cursor_visible.restype = c_bool
 
 def mouse_show_cursor(visible):
-    _lib.TCOD_mouse_show_cursor(c_int(visible))
+    _lib.TCOD_mouse_show_cursor(c_bool(visible))
 
 def mouse_is_cursor_visible():
     return _lib.TCOD_mouse_is_cursor_visible()
@@ -1361,7 +1409,7 @@ def random_set_distribution(rnd, dist) :
 	_lib.TCOD_random_set_distribution(rnd, dist)
 
 def random_get_int(rnd, mi, ma):
-    return _lib.TCOD_random_get_int(rnd, mi, ma)
+    return _lib.TCOD_random_get_int(c_void_p(rnd), mi, ma)
 
 def random_get_float(rnd, mi, ma):
     return _lib.TCOD_random_get_float(rnd, c_float(mi), c_float(ma))
@@ -1462,22 +1510,57 @@ def map_copy(source, dest):
     return _lib.TCOD_map_copy(source, dest)
 
 def map_set_properties(m, x, y, isTrans, isWalk):
-    _lib.TCOD_map_set_properties(m, x, y, c_int(isTrans), c_int(isWalk))
+    _lib.TCOD_map_set_properties(c_void_p(m), x, y, isTrans, isWalk)
 
 def map_clear(m,walkable=False,transparent=False):
-    _lib.TCOD_map_clear(m,c_int(walkable),c_int(transparent))
+    _lib.TCOD_map_clear(m,c_bool(transparent),c_bool(walkable))
+
+# mirror of the C map_t, to reach the cells directly
+class _CMap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', c_void_p),
+              ]
+
+# set the properties of all the cells at once, from two sequences of booleans
+# (or numpy arrays) in row-major order. each C cell is a byte with bit 0 for
+# transparent, bit 1 for walkable and bit 2 for fov
+def map_set_properties_bulk(m, transparent, walkable):
+    cmap = cast(m, POINTER(_CMap)).contents
+    if (numpy_available and isinstance(transparent, numpy.ndarray) and isinstance(walkable, numpy.ndarray)):
+        #numpy arrays, combine the bits with numpy
+        cells = (transparent.astype(numpy.uint8) | (walkable.astype(numpy.uint8) << 1)).tobytes()
+    else:
+        cells = bytes(bytearray([int(t) | (int(w) << 1) for (t, w) in zip(transparent, walkable)]))
+    if len(cells) != cmap.nbcells:
+        raise ValueError('expected %d cells, got %d' % (cmap.nbcells, len(cells)))
+    memmove(cmap.cells, cells, cmap.nbcells)
+
+# translation table from a C cell to its fov bit
+_FOV_BITS = bytes(bytearray([(i >> 2) & 1 for i in range(256)]))
+
+# the result of the last map_compute_fov for all the cells at once, in
+# row-major order: a numpy boolean array if numpy is available, a bytearray
+# of 0s and 1s otherwise
+def map_get_fov(m):
+    cmap = cast(m, POINTER(_CMap)).contents
+    cells = string_at(cmap.cells, cmap.nbcells)
+    if numpy_available:
+        return (numpy.frombuffer(cells, dtype=numpy.uint8) & 4) != 0
+    return bytearray(cells.translate(_FOV_BITS))
 
 def map_compute_fov(m, x, y, radius=0, light_walls=True, algo=FOV_RESTRICTIVE ):
-    _lib.TCOD_map_compute_fov(m, x, y, c_int(radius), c_bool(light_walls), c_int(algo))
+    _lib.TCOD_map_compute_fov(c_void_p(m), x, y, radius, light_walls, algo)
 
 def map_is_in_fov(m, x, y):
-    return _lib.TCOD_map_is_in_fov(m, x, y)
+    return _lib.TCOD_map_is_in_fov(c_void_p(m), x, y)
 
 def map_is_transparent(m, x, y):
-    return _lib.TCOD_map_is_transparent(m, x, y)
+    return _lib.TCOD_map_is_transparent(c_void_p(m), x, y)
 
 def map_is_walkable(m, x, y):
-    return _lib.TCOD_map_is_walkable(m, x, y)
+    return _lib.TCOD_map_is_walkable(c_void_p(m), x, y)
 
 def map_delete(m):
     return _lib.TCOD_map_delete(m)
@@ -1506,7 +1589,7 @@ def path_new_using_function(w, h, func, userdata=0, dcost=1.41):
             py_object(userdata), c_float(dcost)), cbk_func)
 
 def path_compute(p, ox, oy, dx, dy):
-    return _lib.TCOD_path_compute(p[0], ox, oy, dx, dy)
+    return _lib.TCOD_path_compute(c_void_p(p[0]), ox, oy, dx, dy)
 
 def path_get_origin(p):
     x = c_int()
@@ -1538,7 +1621,7 @@ def path_is_empty(p):
 def path_walk(p, recompute):
     x = c_int()
     y = c_int()
-    if _lib.TCOD_path_walk(p[0], byref(x), byref(y), c_int(recompute)):
+    if _lib.TCOD_path_walk(p[0], byref(x), byref(y), c_bool(recompute)):
         return x.value, y.value
     return None,None
 
@@ -1550,8 +1633,31 @@ _lib.TCOD_dijkstra_is_empty.restype = c_bool
 _lib.TCOD_dijkstra_path_walk.restype = c_bool
 _lib.TCOD_dijkstra_get_distance.restype = c_float
 
+class _CDijkstra(Structure):
+    _fields_=[('diagonal_cost', c_int),
+              ('width', c_int),
+              ('height', c_int),
+              ('nodes_max', c_int),
+              ('map', c_void_p),
+              ('func', c_void_p),
+              ('user_data', c_void_p),
+              ('distances', c_void_p),
+              ('nodes', c_void_p),
+              ('path', c_void_p),
+              ]
+
+# TCOD_dijkstra_compute walks its whole node queue, also past the nodes it
+# queued when some cells can't be reached. the queue is left uninitialized by
+# TCOD_dijkstra_new, so clear it, or the distances depend on whatever was in
+# memory before
+def _dijkstra_clear_nodes(d):
+    if d:
+        data = cast(d, POINTER(_CDijkstra)).contents
+        memset(data.nodes, 0, data.nodes_max * sizeof(c_uint))
+    return d
+
 def dijkstra_new(m, dcost=1.41):
-    return (_lib.TCOD_dijkstra_new(c_void_p(m), c_float(dcost)), None)
+    return (_dijkstra_clear_nodes(_lib.TCOD_dijkstra_new(c_void_p(m), c_float(dcost))), None)
 
 def dijkstra_new_using_function(w, h, func, userdata=0, dcost=1.41):
     cbk_func = PATH_CBK_FUNC(func)
@@ -1565,7 +1671,7 @@ def dijkstra_path_set(p, x, y):
     return _lib.TCOD_dijkstra_path_set(p[0], c_int(x), c_int(y))
 
 def dijkstra_get_distance(p, x, y):
-    return _lib.TCOD_dijkstra_get_distance(p[0], c_int(x), c_int(y))
+    return _lib.TCOD_dijkstra_get_distance(c_void_p(p[0]), x, y)
 
 def dijkstra_size(p):
     return _lib.TCOD_dijkstra_size(p[0])
@@ -1671,7 +1777,7 @@ def bsp_new_with_size(x, y, w, h):
     return Bsp(_lib.TCOD_bsp_new_with_size(x, y, w, h))
 
 def bsp_split_once(node, horizontal, position):
-    _lib.TCOD_bsp_split_once(node.p, c_int(horizontal), position)
+    _lib.TCOD_bsp_split_once(node.p, c_bool(horizontal), position)
 
 def bsp_split_recursive(node, randomizer, nb, minHSize, minVSize, maxHRatio,
                         maxVRatio):
@@ -1887,7 +1993,7 @@ def namegen_generate(name) :
     return _lib.TCOD_namegen_generate(name, 0)
 
 def namegen_generate_custom(name, rule) :
-    return _lib.TCOD_namegen_generate(name, rule, 0)
+    return _lib.TCOD_namegen_generate_custom(name, rule, 0)
 
 def namegen_get_sets():
     nb=_lib.TCOD_namegen_get_nb_sets_wrapper()
@@ -1899,4 +2005,14 @@ def namegen_get_sets():
 def namegen_destroy() :
     _lib.TCOD_namegen_destroy()
 
-
+############################
+# fast paths
+############################
+# with the prototypes set up above, these wrappers would only pass a handle
+# and a color, or nothing, on, so call the C functions directly
+console_set_default_foreground = _lib.TCOD_console_set_default_foreground
+console_set_default_background = _lib.TCOD_console_set_default_background
+console_clear = _lib.TCOD_console_clear
+console_flush = _lib.TCOD_console_flush
+console_is_window_closed = _lib.TCOD_console_is_window_closed
+sys_elapsed_milli = _lib.TCOD_sys_elapsed_milli
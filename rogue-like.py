@@ -1,7 +1,23 @@
 import libtcodpy as libtcod
+import os
+import sys
 import math
+import random
 import textwrap
 import shelve
+import array
+import struct
+import zlib
+import heapq
+import threading
+import collections
+import atexit
+import timeit
+import json
+import csv
+
+if libtcod.numpy_available: #use NumPy for the tile arrays if libtcodpy found it
+    import numpy
 
 #############
 # CONSTANTS #
@@ -22,15 +38,39 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 10
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 10
 MSG_HEIGHT = PANEL_HEIGHT - 2
+MSG_HISTORY = 500 #messages kept for the message log (see show_message_log)
+MSG_WRAP_CACHE = 1000 #wrapped messages remembered, most messages come back again and again
 INVENTORY_WIDTH = 35
 CHARACTER_SCREEN_WIDTH = 30
 LEVEL_SCREEN_WIDTH = 40
 
+#the random streams of a game, seeded separately so that e.g. the monsters' moves don't change the next level
+#(each level also gets its own 'map' and 'loot' streams, see generate_level)
+RANDOM_STREAMS = ['ai']
+
+#how many levels the player left are kept, so they can be revisited without generating them again
+LEVEL_CACHE_SIZE = 5
+
+#how many FOV maps of forgotten levels are kept for reuse
+FOV_SPARE_MAPS = 2
+
 #parameters for dungeon generator
 ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 30
 
+#what place_objects puts in the rooms. the tables are [value, from dungeon level] pairs (see from_dungeon_level):
+#how many monsters and items at most in a room, and the chances of each kind of monster and item
+MAX_MONSTERS = [[2, 1], [3, 4], [5, 6]]
+MONSTER_CHANCES = {'orc': [[80, 1]], 'troll': [[15, 3], [30, 5], [60, 7]]}
+MAX_ITEMS = [[1, 1], [2, 4]]
+ITEM_CHANCES = {'heal': [[35, 1]], 'lightning': [[25, 4]], 'fireball': [[25, 6]], 'confuse': [[10, 2]],
+    'sword': [[5, 4]], 'shield': [[15, 8]]}
+
+#the fighter stats of each kind of monster
+MONSTER_STATS = {'orc': {'hp': 20, 'defense': 0, 'power': 4, 'xp': 35},
+    'troll': {'hp': 30, 'defense': 2, 'power': 8, 'xp': 100}}
+
 #spell values
 HEAL_AMOUNT = 40
 LIGHTNING_DAMAGE = 40
@@ -48,11 +88,55 @@ FOV_ALGO = 0 #default FOV algorithm
 FOV_LIGHT_WALLS = True #light walls or not
 TORCH_RADIUS = 10
 
-#number of frames to wait after moving/attacking
+#monsters fall asleep (and cost nothing) when they're farther than SLEEP_RADIUS from the player, or when they
+#haven't seen him for SLEEP_TURNS turns. they wake up when they see him, get hurt, or hear a fight within
+#NOISE_RADIUS
+SLEEP_RADIUS = 15
+SLEEP_TURNS = 10
+NOISE_RADIUS = 8
+
+#diagonal step cost for the monsters' distance map (1.0 = diagonals cost the same as straight steps)
+FLOW_DIAGONAL_COST = 1.41
+
+#if at least this many map cells changed in a frame, repaint the whole map with three bulk calls
+#instead of one call per cell (0 = always repaint in bulk)
+BULK_RENDER_THRESHOLD = 300
+
+#number of ticks to wait after moving/attacking
 PLAYER_SPEED = 3
 DEFAULT_SPEED = 12
 DEFAULT_ATTACK_SPEED = 30
 
+#game time runs at this many ticks per second, however fast the screen is rendered (one tick per frame when
+#headless). after a slow frame or a pause, like a menu, the game time doesn't move more than MAX_FRAME_TICKS
+TICKS_PER_SECOND = 60
+MAX_FRAME_TICKS = 4
+
+#savegame format
+SAVE_MAGIC = b'RLSV'
+SAVE_VERSION = 1
+SAVE_COMPRESS = True #zlib-compress the savegame sections
+
+#replays (see Replay): every new game is recorded, and written to REPLAY_FILE when it ends
+REPLAY_MAGIC = b'RLRP'
+REPLAY_FILE = 'replay'
+
+#profiling (see enable_profiling): the phases of a frame that are timed, how many of the last frames the
+#percentiles are computed on, how often the overlay is updated, in frames, and the base name of the dump files
+PROFILE_PHASES = ['input', 'fov', 'tiles', 'objects', 'panel', 'flush', 'keys', 'ai', 'frame']
+PROFILE_WINDOW = 120
+PROFILE_REFRESH = 30
+PROFILE_FILE = 'profile'
+
+#drawing layers, from the bottom up. the objects of a tile are drawn in the order of their layers, and in the
+#order they were put on the level within a layer
+LAYER_CORPSES = 0
+LAYER_STAIRS = 1
+LAYER_ITEMS = 2
+LAYER_ACTORS = 3
+LAYER_PLAYER = 4
+NUM_LAYERS = 5
+
 #available hotkeys
 HOTKEY_OPTIONS = [libtcod.KEY_1, libtcod.KEY_2, libtcod.KEY_3, libtcod.KEY_4]
 
@@ -116,6 +200,180 @@ class Tile:
         if block_sight is None: block_sight = blocked
         self.block_sight = block_sight
 
+def new_tile_array(size, value):
+    #one byte per tile: a NumPy bool array if available, a plain array of bytes otherwise
+    if libtcod.numpy_available:
+        return numpy.array([value] * size, dtype = numpy.bool_)
+    return array.array('B', [value] * size)
+
+class TileMap:
+    #the properties of all the map tiles, kept in flat arrays instead of one Tile object per tile
+    #tiles are stored row by row, so the tile (x, y) is at index y * width + x
+    def __init__(self, width, height, blocked = True):
+        self.width = width
+        self.height = height
+        self.blocked = new_tile_array(width * height, blocked)
+        self.block_sight = new_tile_array(width * height, blocked)
+        self.explored = new_tile_array(width * height, False)
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        #build a tile map from an old list-of-lists of Tile objects (old savegames)
+        tile_map = cls(len(tiles), len(tiles[0]))
+        for x in range(tile_map.width):
+            for y in range(tile_map.height):
+                i = y * tile_map.width + x
+                tile_map.blocked[i] = tiles[x][y].blocked
+                tile_map.block_sight[i] = tiles[x][y].block_sight
+                tile_map.explored[i] = tiles[x][y].explored
+        return tile_map
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, x):
+        #so that old code can still use map[x][y].blocked
+        return TileColumn(self, x)
+
+    def is_blocked(self, x, y):
+        return self.blocked[y * self.width + x]
+
+    def is_explored(self, x, y):
+        return self.explored[y * self.width + x]
+
+    def carve(self, x, y):
+        #make a tile passable and see-through
+        i = y * self.width + x
+        self.blocked[i] = False
+        self.block_sight[i] = False
+
+class TileColumn:
+    #a column of the tile map, returned by map[x]
+    def __init__(self, tile_map, x):
+        self.tile_map = tile_map
+        self.x = x
+
+    def __len__(self):
+        return self.tile_map.height
+
+    def __getitem__(self, y):
+        return TileRef(self.tile_map, y * self.tile_map.width + self.x)
+
+class TileRef(object):
+    #a view of a single tile, returned by map[x][y]. reading or writing its attributes goes to the tile arrays
+    __slots__ = ('tile_map', 'index')
+
+    def __init__(self, tile_map, index):
+        self.tile_map = tile_map
+        self.index = index
+
+    @property
+    def blocked(self):
+        return bool(self.tile_map.blocked[self.index])
+
+    @blocked.setter
+    def blocked(self, value):
+        self.tile_map.blocked[self.index] = value
+
+    @property
+    def block_sight(self):
+        return bool(self.tile_map.block_sight[self.index])
+
+    @block_sight.setter
+    def block_sight(self, value):
+        self.tile_map.block_sight[self.index] = value
+
+    @property
+    def explored(self):
+        return bool(self.tile_map.explored[self.index])
+
+    @explored.setter
+    def explored(self, value):
+        self.tile_map.explored[self.index] = value
+
+class ObjectList:
+    #the objects of a level, one bucket per drawing layer. iterating goes through the layers from the bottom up,
+    #so the drawing order never depends on where an object was inserted, and adding, removing or moving an
+    #object to another layer doesn't shift a list
+    def __init__(self, objects = ()):
+        self.layers = [collections.OrderedDict() for i in range(NUM_LAYERS)]
+        for obj in objects:
+            self.add(obj)
+
+    def add(self, obj):
+        self.layers[obj.layer][obj] = None
+
+    def remove(self, obj):
+        del self.layers[obj.layer][obj]
+
+    def set_layer(self, obj, layer):
+        #move an object to another layer, on top of the objects already there
+        self.remove(obj)
+        obj.layer = layer
+        self.add(obj)
+
+    def __iter__(self):
+        for layer in self.layers:
+            for obj in layer:
+                yield obj
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers)
+
+    def __contains__(self, obj):
+        return obj in self.layers[obj.layer]
+
+    def index(self, obj):
+        #position of an object in the drawing order (used by the savegame)
+        for (i, other) in enumerate(self):
+            if other is obj:
+                return i
+        raise ValueError('object not on the level')
+
+class SpatialIndex:
+    #the objects of a level, indexed by the tile they stand on, so looking up a tile doesn't scan every object.
+    #the objects of a tile are kept in drawing order, like the level's ObjectList
+    def __init__(self, objects = ()):
+        self.tiles = {}
+        for obj in objects:
+            self.add(obj)
+
+    def add(self, obj):
+        key = (obj.x, obj.y)
+        if key not in self.tiles:
+            self.tiles[key] = [obj]
+            return
+        #a tile rarely has more than a couple of objects, find the top of the object's layer
+        tile_objects = self.tiles[key]
+        i = len(tile_objects)
+        while i > 0 and tile_objects[i - 1].layer > obj.layer:
+            i -= 1
+        tile_objects.insert(i, obj)
+
+    def remove(self, obj):
+        key = (obj.x, obj.y)
+        tile_objects = self.tiles[key]
+        tile_objects.remove(obj)
+        if not tile_objects:
+            del self.tiles[key]
+
+    def move(self, obj, x, y):
+        #update the index and the object's coordinates together
+        self.remove(obj)
+        obj.x = x
+        obj.y = y
+        self.add(obj)
+
+    def at(self, x, y):
+        #returns the objects on a tile (an empty tuple if there are none)
+        return self.tiles.get((x, y), ())
+
+    def is_blocked(self, x, y):
+        for obj in self.tiles.get((x, y), ()):
+            if obj.blocks:
+                return True
+        return False
+
 class Rect:
     #a rectangle on the map, used to characterize a room
     def __init__(self, x, y, w, h):
@@ -133,11 +391,177 @@ class Rect:
         #returns True is this rectangle intersects with another
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
+class Level:
+    #a dungeon level: its map, its objects (the player too, while it's the current level) and its FOV map
+    def __init__(self, seed, depth, tile_map, objects = None, stairs = None):
+        self.seed = seed
+        self.depth = depth
+        self.map = tile_map
+        if objects is None:
+            objects = ()
+        self.objects = ObjectList(objects)
+        self.object_index = SpatialIndex(objects)
+        self.stairs = stairs
+        self.start = (0, 0) #where the player arrives
+        self.fov_map = None
+
+    def add(self, obj):
+        #put an object on the level while it's generated (nothing is drawn yet)
+        self.objects.add(obj)
+        self.object_index.add(obj)
+
+    def is_blocked(self, x, y):
+        return self.map.is_blocked(x, y) or self.object_index.is_blocked(x, y)
+
+    def delete(self):
+        #give back the FOV map once the level is forgotten
+        if self.fov_map is not None:
+            fov_maps.delete(self.fov_map)
+            self.fov_map = None
+
+class LevelThread(threading.Thread):
+    #generates a level and its FOV map in the background
+    def __init__(self, seed, depth, width, height):
+        threading.Thread.__init__(self)
+        self.size = (width, height)
+        self.arguments = (seed, depth, width, height)
+        self.level = None
+
+    def run(self):
+        level = generate_level(*self.arguments)
+        level.fov_map = fov_maps.new(level.map)
+        self.level = level
+
+class LevelCache:
+    #the levels the player left (least recently used first) and the levels being generated ahead of time,
+    #keyed by seed and dungeon level
+    def __init__(self, size = LEVEL_CACHE_SIZE):
+        self.size = size
+        self.levels = collections.OrderedDict()
+        self.pending = {}
+
+    def prefetch(self, seed, depth):
+        #start generating a level in the background, unless it's already there
+        key = (seed, depth)
+        if key in self.levels or key in self.pending:
+            return
+        thread = LevelThread(seed, depth, MAP_WIDTH, MAP_HEIGHT)
+        self.pending[key] = thread
+        thread.start()
+
+    def get(self, seed, depth):
+        #returns a level from the cache, or from its background thread, or generates it right away
+        key = (seed, depth)
+        if key in self.levels:
+            return self.levels.pop(key)
+        if key in self.pending:
+            thread = self.pending.pop(key)
+            thread.join()
+            if thread.level is not None and thread.size == (MAP_WIDTH, MAP_HEIGHT):
+                return thread.level
+            if thread.level is not None:
+                thread.level.delete()
+        return generate_level(seed, depth, MAP_WIDTH, MAP_HEIGHT)
+
+    def wait(self):
+        #wait until the levels being generated are ready
+        for thread in self.pending.values():
+            thread.join()
+
+    def store(self, level):
+        #keep a level the player left, forgetting the least recently used one if the cache is full
+        self.levels[(level.seed, level.depth)] = level
+        while len(self.levels) > self.size:
+            (key, old_level) = self.levels.popitem(last = False)
+            old_level.delete()
+
+    def clear(self):
+        #forget all levels, e.g. when a new game starts
+        self.wait()
+        for thread in self.pending.values():
+            if thread.level is not None:
+                thread.level.delete()
+        self.pending = {}
+        for level in self.levels.values():
+            level.delete()
+        self.levels.clear()
+
+class FovMaps:
+    #makes the FOV maps of the levels, filling them in bulk from the tile arrays, and keeps the maps of
+    #forgotten levels to reuse them for new levels of the same size
+    def __init__(self, spare = FOV_SPARE_MAPS):
+        self.spare = spare
+        self.free = [] #(width, height, FOV map)
+        self.lock = threading.Lock() #levels are also made by LevelThreads
+
+    def new(self, tile_map):
+        #returns a FOV map matching a tile map
+        fov = None
+        with self.lock:
+            for i in range(len(self.free)):
+                (width, height, free_fov) = self.free[i]
+                if (width, height) == (tile_map.width, tile_map.height):
+                    fov = free_fov
+                    del self.free[i]
+                    break
+        if fov is None:
+            fov = libtcod.map_new(tile_map.width, tile_map.height)
+        self.fill(fov, tile_map)
+        return fov
+
+    def fill(self, fov, tile_map):
+        #set every cell from the tile arrays, in one go
+        if libtcod.numpy_available:
+            transparent = numpy.logical_not(tile_map.block_sight)
+            walkable = numpy.logical_not(tile_map.blocked)
+        else:
+            transparent = [not block_sight for block_sight in tile_map.block_sight]
+            walkable = [not blocked for blocked in tile_map.blocked]
+        libtcod.map_set_properties_bulk(fov, transparent, walkable)
+
+    def update_tile(self, fov, tile_map, x, y):
+        #a single tile changed, only update its cell
+        i = y * tile_map.width + x
+        libtcod.map_set_properties(fov, x, y, not tile_map.block_sight[i], not tile_map.blocked[i])
+
+    def delete(self, fov):
+        #keep a FOV map that's no longer used for a later level, or free it if there are enough spare ones
+        with self.lock:
+            if len(self.free) < self.spare:
+                self.free.append((libtcod.map_get_width(fov), libtcod.map_get_height(fov), fov))
+                return
+        libtcod.map_delete(fov)
+
+class TurnQueue:
+    #the monsters of the current level, ordered by the game time of their next turn, so only the ones whose
+    #turn came are looked at
+    def __init__(self, objects = (), now = 0):
+        self.heap = []
+        self.count = 0 #monsters due at the same time act in the order they were scheduled
+        for obj in objects:
+            if obj.ai and not obj.asleep:
+                self.schedule(obj, max(obj.next_turn, now))
+
+    def schedule(self, obj, time):
+        obj.next_turn = time
+        heapq.heappush(self.heap, (time, self.count, obj))
+        self.count += 1
+
+    def pop_due(self, end):
+        #returns the next monster whose turn comes before the time end, or None. entries of dead monsters,
+        #or of monsters scheduled again since, are skipped
+        heap = self.heap
+        while heap and heap[0][0] < end:
+            (time, count, obj) = heapq.heappop(heap)
+            if obj.ai is not None and obj.next_turn == time:
+                return obj
+        return None
+
 class Object:
     #this is a generic object: the player, a monster, item, stair, etc.
     #always represented by a character on the screen
     def __init__(self, x, y, char, name, color, blocks = False, always_visible = False,
-        fighter = None, ai = None, item = None, equipment = None, speed = DEFAULT_SPEED, label = None):
+        fighter = None, ai = None, item = None, equipment = None, speed = DEFAULT_SPEED, label = None, layer = None):
 
         self.x = x
         self.y = y
@@ -149,7 +573,9 @@ class Object:
         self.fighter = fighter
         self.ai = ai
         self.speed = speed
-        self.wait = 0
+        self.wait = 0 #delay set by the last action, before the next turn
+        self.next_turn = 0 #game time of the next turn
+        self.asleep = False #sleeping monsters don't take turns
         self.item = item
         self.equipment = equipment
         self.label = label
@@ -171,11 +597,16 @@ class Object:
             self.item = Item()
             self.item.owner = self
 
+        if layer is None:
+            layer = object_layer(self)
+        self.layer = layer #drawing layer, see ObjectList
+
     def move(self, dx, dy):
         #move by the given amount, if destination is not blocked
-        if not is_blocked(self.x +dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+        if not state.is_blocked(self.x +dx, self.y + dy):
+            self.clear()
+            state.object_index.move(self, self.x + dx, self.y + dy)
+            self.clear()
             self.wait = self.speed
 
     def move_towards(self, target_x, target_y):
@@ -190,6 +621,26 @@ class Object:
         dy = int(round(dy / distance))
         self.move(dx, dy)
 
+    def chase_player(self):
+        #step to the free neighbouring tile that is closest to the player, walking around walls.
+        #the distances come from the flow field shared by every monster, so this is just a few lookups
+        state.update_flow_field()
+        flow_field = state.flow_field
+        best = libtcod.dijkstra_get_distance(flow_field, self.x, self.y)
+        if best < 0: #the player can't be reached from here, just head in his direction
+            self.move_towards(state.player.x, state.player.y)
+            return
+
+        step = None
+        is_blocked = state.is_blocked
+        for (dx, dy) in NEIGHBOURS:
+            distance = libtcod.dijkstra_get_distance(flow_field, self.x + dx, self.y + dy)
+            if distance >= 0 and distance < best and not is_blocked(self.x + dx, self.y + dy):
+                best = distance
+                step = (dx, dy)
+        if step is not None:
+            self.move(step[0], step[1])
+
     def distance_to(self, other):
         #return distance to another object
         dx = other.x - self.x
@@ -200,22 +651,23 @@ class Object:
         #return the distance to some coordinates
         return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 
-    def send_to_back(self):
-        #make this object be drawn first, so all others appear above it if in the same tile
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
+    def set_layer(self, layer):
+        #move this object to another drawing layer of the current level
+        state.object_index.remove(self)
+        state.objects.set_layer(self, layer)
+        state.object_index.add(self)
+        self.clear()
 
     def draw(self):
         #only show if it's visible to the player
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored)) :
+        if (state.in_fov(self.x, self.y) or (self.always_visible and state.map.is_explored(self.x, self.y))) :
             #set the color and then draw the character that represents this object at its position
             libtcod.console_set_default_foreground(con, self.color)
             libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
 
     def clear(self):
-        #erase the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
+        #erase the character that represents this object (its cell gets repainted by the next render_all)
+        state.mark_dirty(self.x, self.y)
 
 class Fighter:
     #combat-related properties and methods (monster, player, npc)
@@ -229,20 +681,41 @@ class Fighter:
         self.attack_speed = attack_speed
         self.god_mode = god_mode
 
+        #running totals of the bonuses from all equipped items, updated on equip/dequip
+        self.power_bonus = 0
+        self.defense_bonus = 0
+        self.max_hp_bonus = 0
+
     @property
-    def power(self): #return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_power + bonus
+    def power(self): #return actual power, including the bonuses from all equipped items
+        return self.base_power + self.power_bonus
 
     @property
-    def defense(self):  #return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_defense + bonus
+    def defense(self):  #return actual defense, including the bonuses from all equipped items
+        return self.base_defense + self.defense_bonus
  
     @property
-    def max_hp(self):  #return actual max_hp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_hp + bonus
+    def max_hp(self):  #return actual max_hp, including the bonuses from all equipped items
+        return self.base_max_hp + self.max_hp_bonus
+
+    def add_bonus(self, equipment):
+        #an item was equipped, add its bonuses to the totals
+        self.power_bonus += equipment.power_bonus
+        self.defense_bonus += equipment.defense_bonus
+        self.max_hp_bonus += equipment.max_hp_bonus
+
+    def remove_bonus(self, equipment):
+        #an item was dequipped, take its bonuses out of the totals
+        self.power_bonus -= equipment.power_bonus
+        self.defense_bonus -= equipment.defense_bonus
+        self.max_hp_bonus -= equipment.max_hp_bonus
+
+    def recompute_bonuses(self):
+        #rebuild the totals from scratch, by summing up the bonuses from all equipped items
+        equipped = get_all_equipped(self.owner)
+        self.power_bonus = sum(equipment.power_bonus for equipment in equipped)
+        self.defense_bonus = sum(equipment.defense_bonus for equipment in equipped)
+        self.max_hp_bonus = sum(equipment.max_hp_bonus for equipment in equipped)
 
     def attack(self, target):
         #a simple formula for attack damage
@@ -252,6 +725,7 @@ class Fighter:
             #make the target take some damage
             message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.')
             target.fighter.take_damage(damage)
+            state.make_noise(self.owner.x, self.owner.y)
         else:
             message(self.owner.name.capitalize() + ' attacks ' + target.name + ', but it has no effect!')
 
@@ -261,6 +735,7 @@ class Fighter:
         #apply damage if possible
         if damage > 0 and not self.god_mode:
             self.hp -= damage
+            state.wake_up(self.owner)
 
             #check for death. if there's a death function, call it
             if self.hp <= 0:
@@ -268,6 +743,7 @@ class Fighter:
                 if function is not None:
                     function(self.owner)
 
+                player = state.player
                 if self.owner != player and not player.fighter.god_mode: #yield experience to the player
                     player.fighter.xp +=self.xp
 
@@ -290,19 +766,30 @@ class Fighter:
 
 class BasicMonster:
     #AI for a basic monster
+    unseen_turns = 0 #turns since it last saw the player
+
     def take_turn(self):
         #a basic monster takes its turn. If you can see it, it can see you
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y) and not player.fighter.god_mode:
+        player = state.player
+        seen = state.in_fov(monster.x, monster.y)
+        if seen and not player.fighter.god_mode:
 
             #move towards player is far away
             if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+                monster.chase_player()
 
             #if close enough, attack! (if the player is still alive)
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
 
+        if seen:
+            self.unseen_turns = 0
+        else: #fall asleep if the player is out of reach
+            self.unseen_turns += 1
+            if self.unseen_turns >= SLEEP_TURNS or monster.distance_to(player) > SLEEP_RADIUS:
+                monster.asleep = True
+
 class ConfusedMonster:
     #AI for a temporarily confused monster (reverts to previos AI after a while)
     def __init__(self, old_ai, num_turns = CONFUSE_NUM_TURNS):
@@ -312,7 +799,8 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0: #still confused
             #move in random direction and decrease the number of turns confused
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            (dx, dy) = state.rng['ai'].get_ints(-1, 1, 2)
+            self.owner.move(dx, dy)
             self.num_turns -= 1
 
         else: #restore the previous AI (this one will be deleted because it's not referenced anymore)
@@ -326,35 +814,19 @@ class Item:
 
     def pick_up(self):
         #add to a player's inventory and remove from the map
+        item_quantity = state.inventory.count_named(self.owner.name) + 1
         
-        item_quantity = 1
-        for obj in inventory:
-            if obj.name == self.owner.name:
-                item_quantity += 1
-        
-        if len(inventory) >= 26:
+        if len(state.inventory) >= 26:
             message('Your inventory is full.  You cannot pick up a ' + self.owner.name + '!', libtcod.green)
         elif self.owner.equipment and item_quantity > 9:
             message('You can\'t hold any more ' + self.owner.name + 's.', libtcod.green)
         else:
-            inventory.append(self.owner)
-            objects.remove(self.owner)
+            if self.owner.equipment: #equipment doesn't stack, each piece gets its own label
+                self.owner.label = state.inventory.free_label(self.owner.name)
+            state.inventory.add(self.owner)
+            remove_object(self.owner)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
 
-            
-            if not self.owner.equipment:
-                if not self.owner.label in inventory_dict.keys():
-                    inventory_dict[self.owner.label] = 1
-                else:
-                    inventory_dict[self.owner.label] +=1
-            else:
-                i = 1
-                self.owner.label = self.owner.name + ' ' + str(i)
-                while self.owner.label in inventory_dict.keys():
-                    i += 1
-                    self.owner.label = self.owner.name + ' ' + str(i)
-                inventory_dict[self.owner.label] = 'unequipped'
-
             #special case: automatically equip, if the corresponding equipment slot is unused
             equipment = self.owner.equipment
             if equipment and get_equipped_in_slot(equipment.slot) is None:
@@ -366,14 +838,10 @@ class Item:
             self.owner.equipment.dequip()
 
         #add to the map and remove from the player's inventory. also place at the player's coordinates
-        objects.append(self.owner)
-        inventory.remove(self.owner)
-        if self.owner.equipment or (not self.owner.equipment and inventory_dict[self.owner.label] == 1):
-            del inventory_dict[self.owner.label]
-        else:
-            inventory_dict[self.owner.label] -= 1
-        self.owner.x = player.x
-        self.owner.y = player.y
+        self.owner.x = state.player.x
+        self.owner.y = state.player.y
+        add_object(self.owner)
+        state.inventory.remove(self.owner)
         message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
     def use(self):
@@ -387,12 +855,8 @@ class Item:
             message('The ' + self.owner.name + ' cannot be used.')
         else:
             if self.use_function() != 'cancelled':
-                inventory.remove(self.owner) #destroy after use, unless it was cancelled for some reason
-                if inventory_dict[self.owner.label] > 1:
-                    inventory_dict[self.owner.label] -= 1
-                elif inventory_dict[self.owner.label] == 1:
-                    del inventory_dict[self.owner.label]
-                
+                state.inventory.remove(self.owner) #destroy after use, unless it was cancelled for some reason
+
 class Equipment:
     #an object that can be equipped, yielding bonuses, automatically adds the Item component
     def __init__(self, slot, power_bonus = 0, defense_bonus = 0, max_hp_bonus = 0):
@@ -416,14 +880,16 @@ class Equipment:
 
         #equip an object and show a message
         self.is_equipped = True
-        inventory_dict[self.owner.label] = self.slot
+        state.player.fighter.add_bonus(self)
+        state.inventory.update(self.owner)
         message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
 
     def dequip(self):
         #dequip object and show a message
         if not self.is_equipped: return
         self.is_equipped = False
-        inventory_dict[self.owner.label] = 'unequipped'
+        state.player.fighter.remove_bonus(self)
+        state.inventory.update(self.owner)
         message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
 
 class Hotkey:
@@ -442,40 +908,32 @@ class Hotkey:
                 self.prompt = '[' + str(num) + '] ' + self.name.capitalize() + '\n'
             
     def compute_state(self):
+        #how many are left of a stackable item, or whether the equipment is equipped
         if self.type == 'stackable':
-            self.state = 0
-            for obj in inventory:
-                if obj.label == self.name:
-                    self.state += 1
+            self.state = state.inventory.count(self.name)
         elif self.type == 'equipment':
-            for obj in inventory:
-                if obj.label == self.name:
-                    self.state = obj.equipment.is_equipped
+            obj = state.inventory.first(self.name)
+            if obj is not None:
+                self.state = obj.equipment.is_equipped
                     
     def configure(self):
         if self.button in HOTKEY_OPTIONS:
-            hotkeys.append(self)
+            state.hotkeys.append(self)
             self.compute_state()
     
     def use(self):
         self.compute_state()
-        if self.state != 0 or self.type == 'equipment':
-            i = 0
-            hot_object = False
-            while not hot_object:
-                if inventory[i].label == self.name:
-                    hot_object = inventory[i]
-                i += 1
-        
+        hot_object = state.inventory.first(self.name)
+        if hot_object is not None:
             hot_object.item.use()
             
         elif self.state == 0 and self.type == 'stackable':
             message('You no longer have this item.')
 
     def render_gui(self, x, y, key_display):
-        libtcod.console_print_ex(panel, x, y, libtcod.BKGND_NONE, libtcod.LEFT, '[' + key_display + ']')
-        libtcod.console_put_char_ex(panel, x + 4, y, self.char, libtcod.white, libtcod.BKGND_NONE)
         self.compute_state()
+        libtcod.console_print_ex(panel, x, y, libtcod.BKGND_NONE, libtcod.LEFT, '[' + key_display + ']')
+        libtcod.console_put_char_ex(panel, x + 4, y, self.char, libtcod.white, libtcod.black)
         if self.type == 'stackable':
             libtcod.console_print_ex(panel, x + 6, y, libtcod.BKGND_NONE, libtcod.LEFT, str(self.state))
         elif self.type == 'equipment' and self.state:
@@ -484,78 +942,746 @@ class Hotkey:
         
     
 
+class InputExhausted(Exception):
+    #raised by an input source when it has no more input, which ends a headless game
+    pass
+
+class InputSource:
+    #drives the game instead of the keyboard and mouse (see run_headless). subclasses implement
+    #next_command(), which returns a key name (see KEYS) or any single character, a letter to choose a
+    #menu option, an (x, y) tuple to pick a target tile, or None when nothing is pressed this frame
+    KEYS = {'up': libtcod.KEY_UP, 'down': libtcod.KEY_DOWN, 'left': libtcod.KEY_LEFT, 'right': libtcod.KEY_RIGHT,
+        'upleft': libtcod.KEY_HOME, 'upright': libtcod.KEY_PAGEUP, 'downleft': libtcod.KEY_END,
+        'downright': libtcod.KEY_PAGEDOWN, 'wait': libtcod.KEY_KP5, 'escape': libtcod.KEY_ESCAPE,
+        'tab': libtcod.KEY_TAB, '1': libtcod.KEY_1, '2': libtcod.KEY_2, '3': libtcod.KEY_3, '4': libtcod.KEY_4,
+        '5': libtcod.KEY_5}
+
+    def next_command(self):
+        raise InputExhausted()
+
+    def frame_ticks(self):
+        #ticks of game time in the current frame (one, there's no real time when headless)
+        return 1
+
+    def next_key(self, key):
+        #fill the key structure with the next key press, like sys_check_for_event does
+        command = self.next_command()
+        key.c = 0
+        if command is None:
+            key.vk = libtcod.KEY_NONE
+        elif command in self.KEYS:
+            key.vk = self.KEYS[command]
+        elif isinstance(command, str) and len(command) == 1:
+            key.vk = libtcod.KEY_CHAR
+            key.c = ord(command)
+        else:
+            raise ValueError('Not a key: ' + repr(command))
+
+    def choose(self, header, options):
+        #answer a menu: a letter picks an option, anything else closes the menu
+        command = self.next_command()
+        if isinstance(command, str) and len(command) == 1:
+            index = ord(command) - ord('a')
+            if index >= 0 and index < len(options):
+                return index
+        return None
+
+    def target(self, max_range = None):
+        #pick a tile for targeting, or (None, None) to cancel
+        command = self.next_command()
+        if isinstance(command, tuple):
+            (x, y) = command
+            if in_fov(x, y) and (max_range is None or state.player.distance(x, y) <= max_range):
+                return (x, y)
+        return (None, None)
+
+class ScriptedInput(InputSource):
+    #plays a fixed list of commands, then ends the game
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.position = 0
+
+    def next_command(self):
+        if self.position >= len(self.commands):
+            raise InputExhausted()
+        command = self.commands[self.position]
+        self.position += 1
+        return command
+
+class ReplayInput(InputSource):
+    #plays the inputs of a Replay again, in the frames they were recorded in and with the same game ticks
+    #per frame, then ends the game
+    def __init__(self, replay):
+        self.replay = replay
+        self.frame = -1
+        self.position = 0 #the next event
+
+    def next_key(self, key):
+        self.frame += 1
+        if self.frame >= len(self.replay.ticks) and self.position >= len(self.replay.events):
+            raise InputExhausted()
+        InputSource.next_key(self, key)
+
+    def next_command(self):
+        #the key pressed in this frame, if any
+        if self.position < len(self.replay.events):
+            (frame, kind, value) = self.replay.events[self.position]
+            if frame == self.frame and kind == REPLAY_KEY:
+                self.position += 1
+                return value
+        return None
+
+    def next_event(self, kind):
+        #the next input, which must be of the given kind and come from this frame
+        if self.position >= len(self.replay.events):
+            raise InputExhausted()
+        (frame, event_kind, value) = self.replay.events[self.position]
+        if frame != self.frame or event_kind != kind:
+            raise ValueError('The replay is out of sync at frame ' + str(self.frame) + '.')
+        self.position += 1
+        return value
+
+    def choose(self, header, options):
+        return self.next_event(REPLAY_MENU)
+
+    def target(self, max_range = None):
+        return self.next_event(REPLAY_TARGET)
+
+    def frame_ticks(self):
+        if self.frame >= len(self.replay.ticks):
+            raise InputExhausted()
+        return self.replay.ticks[self.frame]
+
+class Replay:
+    #the seed of a game and everything the player did, enough to play the game again exactly (see run_replay).
+    #ticks has the ticks of game time of every frame, events the inputs as (frame, kind, value): a key command
+    #(see InputSource), the option chosen in a menu (None if it was closed), or a targeted tile ((None, None)
+    #if cancelled)
+    def __init__(self, seed, ticks = None, events = None):
+        self.seed = seed
+        if ticks is None:
+            ticks = bytearray()
+        if events is None:
+            events = []
+        self.ticks = ticks
+        self.events = events
+
+    def record_key(self, key):
+        command = key_command(key)
+        if command is not None:
+            self.events.append((len(self.ticks), REPLAY_KEY, command))
+
+    def record_choice(self, index):
+        self.events.append((len(self.ticks), REPLAY_MENU, index))
+
+    def record_target(self, x, y):
+        self.events.append((len(self.ticks), REPLAY_TARGET, (x, y)))
+
+    def end_frame(self, ticks):
+        self.ticks.append(ticks)
+
+    def save(self, filename = REPLAY_FILE):
+        strings = StringTable()
+        records = []
+        for (frame, kind, value) in self.events:
+            if kind == REPLAY_KEY:
+                records.append((frame, kind, strings.add(value), 0))
+            elif kind == REPLAY_MENU:
+                records.append((frame, kind, -1 if value is None else value, 0))
+            else:
+                (x, y) = value
+                records.append((frame, kind, -1 if x is None else x, -1 if y is None else y))
+        write_save_file(filename, [(b'SEED', struct.pack('<q', self.seed)), (b'STRS', strings.pack()),
+            (b'TICK', bytes(self.ticks)), (b'INPT', pack_records(records, REPLAY_EVENT))], magic = REPLAY_MAGIC)
+
+    @classmethod
+    def load(cls, filename = REPLAY_FILE):
+        file = SaveFile(filename, REPLAY_MAGIC)
+        strings = file.strings()
+        (seed,) = struct.unpack('<q', file.section(b'SEED'))
+        ticks = bytearray(file.section(b'TICK'))
+        events = []
+        for (frame, kind, a, b) in file.records(b'INPT', REPLAY_EVENT):
+            if kind == REPLAY_KEY:
+                value = strings.get(a)
+            elif kind == REPLAY_MENU:
+                value = None if a < 0 else a
+            else:
+                value = (None, None) if a < 0 else (a, b)
+            events.append((frame, kind, value))
+        file.close()
+        return cls(seed, ticks, events)
+
+def key_command(key):
+    #the InputSource command of a key press, or None for the keys that don't change the game (e.g. Alt+Enter)
+    if key.vk == libtcod.KEY_ENTER and key.lalt:
+        return None
+    if key.vk in KEY_COMMANDS:
+        return KEY_COMMANDS[key.vk]
+    if key.vk == libtcod.KEY_CHAR:
+        return chr(key.c)
+    return None
+
+#the command of each key handled by handle_keys (the numpad moves like the arrows)
+KEY_COMMANDS = dict((vk, command) for (command, vk) in InputSource.KEYS.items())
+KEY_COMMANDS.update({libtcod.KEY_KP8: 'up', libtcod.KEY_KP2: 'down', libtcod.KEY_KP4: 'left',
+    libtcod.KEY_KP6: 'right', libtcod.KEY_KP7: 'upleft', libtcod.KEY_KP9: 'upright', libtcod.KEY_KP1: 'downleft',
+    libtcod.KEY_KP3: 'downright'})
+
+class RandomStream:
+    #a named stream of random numbers. the numbers only depend on the seed, so a level or a whole run can be
+    #reproduced, and they are drawn in Python instead of with a libtcod call for each one
+    def __init__(self, name, seed = 0):
+        self.name = name
+        self.generator = random.Random()
+        self.seed(seed)
+
+    def seed(self, seed, level = 0):
+        #every stream has its own sequence for each seed and dungeon level
+        name = zlib.crc32(self.name.encode('ascii')) & 0xffffffff
+        self.generator.seed(((seed * 1000 + level) << 32) + name)
+
+    def get_int(self, mi, ma):
+        #random integer between mi and ma included, like libtcod.random_get_int
+        return mi + int(self.generator.random() * (ma - mi + 1))
+
+    def get_ints(self, mi, ma, count):
+        #a list of count random integers between mi and ma included
+        uniform = self.generator.random
+        span = ma - mi + 1
+        return [mi + int(uniform() * span) for i in range(count)]
+
+    def get_float(self, mi, ma):
+        return mi + self.generator.random() * (ma - mi)
+
+    def get_floats(self, mi, ma, count):
+        uniform = self.generator.random
+        span = ma - mi
+        return [mi + uniform() * span for i in range(count)]
+
+class Inventory:
+    #the player's items, in the order they were picked up. also keeps, up to date as items come and go or are
+    #(de)equipped, what the inventory menu and the hotkeys show: the items of each label, and the stack count or
+    #equipment state of each label (stacks: a number of items, the slot the piece is on, or 'unequipped'). all
+    #the reads are O(1), version counts the changes so the panel knows when to show them again
+    def __init__(self, items = ()):
+        self.items = []
+        self.labels = {} #label -> items
+        self.names = {} #name -> number of items
+        self.stacks = {}
+        self.slots = {} #slot -> the Equipment on it
+        self.version = 0
+        for obj in items:
+            self.add(obj)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __contains__(self, obj):
+        return obj in self.items
+
+    def index(self, obj):
+        return self.items.index(obj)
+
+    def add(self, obj):
+        self.items.append(obj)
+        self.labels.setdefault(obj.label, []).append(obj)
+        self.names[obj.name] = self.names.get(obj.name, 0) + 1
+        self.update(obj)
+
+    def remove(self, obj):
+        self.items.remove(obj)
+        same = self.labels[obj.label]
+        same.remove(obj)
+        if not same:
+            del self.labels[obj.label]
+        self.names[obj.name] -= 1
+        if self.names[obj.name] == 0:
+            del self.names[obj.name]
+        if obj.equipment and self.slots.get(obj.equipment.slot) is obj.equipment:
+            del self.slots[obj.equipment.slot]
+        self.update(obj)
+
+    def update(self, obj):
+        #an item of the inventory was added, removed, equipped or dequipped
+        self.version += 1
+        label = obj.label
+        if label not in self.labels:
+            self.stacks.pop(label, None)
+        elif obj.equipment:
+            equipment = obj.equipment
+            if equipment.is_equipped:
+                self.stacks[label] = equipment.slot
+                self.slots[equipment.slot] = equipment
+            else:
+                self.stacks[label] = 'unequipped'
+                if self.slots.get(equipment.slot) is equipment:
+                    del self.slots[equipment.slot]
+        else:
+            self.stacks[label] = len(self.labels[label])
+
+    def count(self, label):
+        return len(self.labels.get(label, ()))
+
+    def count_named(self, name):
+        return self.names.get(name, 0)
+
+    def first(self, label):
+        #the first item picked up with a label, or None
+        same = self.labels.get(label)
+        return same[0] if same else None
+
+    def free_label(self, name):
+        #a label for a new piece of equipment: its name and the first number not used yet
+        i = 1
+        while name + ' ' + str(i) in self.labels:
+            i += 1
+        return name + ' ' + str(i)
+
+class MessageLog:
+    #the last MSG_HISTORY messages, as (text, color), oldest first. adding one is cheap: it is only wrapped
+    #into lines when shown, and the wrapped lines of each text and width are cached. version counts the
+    #messages ever added, so a change can be noticed without comparing the messages
+    def __init__(self, messages = ()):
+        self.messages = collections.deque(messages, MSG_HISTORY)
+        self.version = len(self.messages)
+        self.wrapped = {} #(text, width) -> lines
+
+    def add(self, text, color):
+        self.messages.append((text, color))
+        self.version += 1
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def wrap(self, text, width):
+        lines = self.wrapped.get((text, width))
+        if lines is None:
+            if len(self.wrapped) >= MSG_WRAP_CACHE:
+                self.wrapped.clear()
+            lines = self.wrapped[(text, width)] = textwrap.wrap(text, width)
+        return lines
+
+    def last_lines(self, width, count, skip = 0):
+        #the last count lines, as (line, color), oldest first, wrapped to width, after skipping the skip last
+        #ones. only the messages that end up in them are wrapped
+        lines = []
+        for (text, color) in reversed(self.messages):
+            if len(lines) >= count + skip:
+                break
+            lines.extend((line, color) for line in reversed(self.wrap(text, width)))
+        lines = lines[skip:count + skip]
+        lines.reverse()
+        return lines
+
+    def count_lines(self, width):
+        return sum(len(self.wrap(text, width)) for (text, color) in self.messages)
+
+class Profiler:
+    #times the phases of each frame (see PROFILE_PHASES) by wrapping the functions that make them, so nothing
+    #is timed, and nothing costs anything, while profiling is off. keeps every frame for the dump and the last
+    #PROFILE_WINDOW ones for the overlay's percentiles
+    def __init__(self, window = PROFILE_WINDOW):
+        self.timer = timeit.default_timer
+        self.totals = dict((phase, 0.0) for phase in PROFILE_PHASES) #this frame's time in each phase, in seconds
+        self.recent = dict((phase, collections.deque(maxlen = window)) for phase in PROFILE_PHASES)
+        self.frames = [] #every frame's times, in milliseconds and in PROFILE_PHASES order
+        self.wrapped = [] #(owner, name, original function), to undo instrument
+        self.lines = [] #the overlay's text
+        self.overlay = False
+        self.frame_start = self.timer()
+
+    def instrument(self, owner, name, phase):
+        #replace a function of a module or class by one that adds its running time to a phase
+        function = vars(owner)[name]
+        timer = self.timer
+        totals = self.totals
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                totals[phase] += timer() - start
+        self.wrapped.append((owner, name, function))
+        setattr(owner, name, timed)
+
+    def remove(self):
+        #put the original functions back
+        for (owner, name, function) in reversed(self.wrapped):
+            setattr(owner, name, function)
+        self.wrapped = []
+
+    def end_frame(self):
+        now = self.timer()
+        self.totals['frame'] = now - self.frame_start
+        self.frame_start = now
+        times = tuple(self.totals[phase] * 1000 for phase in PROFILE_PHASES)
+        self.frames.append(times)
+        for (phase, time) in zip(PROFILE_PHASES, times):
+            self.recent[phase].append(time)
+            self.totals[phase] = 0.0
+        if self.overlay and len(self.frames) % PROFILE_REFRESH == 1:
+            self.update_lines()
+
+    def update_lines(self):
+        #the overlay: p50, p95 and p99 of the recent frames, in milliseconds, in two columns
+        cells = ['%-7s%5.2f%6.2f%6.2f' % ((phase,) + tuple(percentile(self.recent[phase], p) for p in (50, 95, 99)))
+            for phase in PROFILE_PHASES]
+        rows = (len(cells) + 1) // 2
+        self.lines = [' '.join(['%-7s%5s%6s%6s' % ('ms', 'p50', 'p95', 'p99')] * 2)]
+        for i in range(rows):
+            self.lines.append(' '.join(cells[i::rows]))
+
+    def render(self, con, x, y, width, height):
+        #draw the overlay, over whatever was there
+        libtcod.console_set_default_background(con, libtcod.black)
+        libtcod.console_rect(con, x, y, width, height, True, libtcod.BKGND_SET)
+        libtcod.console_set_default_foreground(con, libtcod.light_gray)
+        for (i, line) in enumerate(self.lines[:height]):
+            libtcod.console_print_ex(con, x, y + i, libtcod.BKGND_NONE, libtcod.LEFT, line)
+
+    def summary(self):
+        #percentiles, mean and maximum of each phase over all the frames, in milliseconds
+        result = {}
+        for (i, phase) in enumerate(PROFILE_PHASES):
+            times = [frame[i] for frame in self.frames]
+            result[phase] = {'p50': percentile(times, 50), 'p95': percentile(times, 95),
+                'p99': percentile(times, 99), 'mean': sum(times) / len(times), 'max': max(times)}
+        return result
+
+    def dump(self, filename = PROFILE_FILE):
+        #write every frame's times to filename.csv, and the summary to filename.json
+        if not self.frames:
+            return
+        with open(filename + '.csv', 'wb') as file:
+            writer = csv.writer(file)
+            writer.writerow(PROFILE_PHASES)
+            writer.writerows(['%.3f' % time for time in frame] for frame in self.frames)
+        with open(filename + '.json', 'w') as file:
+            json.dump({'frames': len(self.frames), 'phases': self.summary()}, file, indent = 1, sort_keys = True)
+
+class GameState:
+    #one game in progress: the player, his inventory and messages, the current level and the maps made from it,
+    #the game time and the random streams. the engine works on the active game (see use_state), and the
+    #functions of the same names (is_blocked, update_fov, advance_time...) are wrappers around its methods, so
+    #several games can be kept in one process, e.g. to simulate or benchmark them one after the other
+    def __init__(self):
+        self.player = None
+        self.inventory = Inventory()
+        self.hotkeys = []
+        self.game_msgs = MessageLog()
+        self.game_state = 'playing'
+        self.dungeon_level = 1
+        self.current_level = None #the Level the player is on
+        self.map = None #the current level's tile map, objects, spatial index, stairs and FOV map
+        self.objects = ObjectList()
+        self.object_index = SpatialIndex()
+        self.stairs = None
+        self.fov_map = None
+        self.fov_recompute = True
+        self.fov_cells = None #whether each tile was in view at the last FOV computation
+        self.visible_tiles = None #whether each tile is painted as in view on the map console
+        self.dirty_tiles = set() #the map cells to repaint at the next render_all
+        self.panel_state = None #what the GUI panel shows (see get_panel_state)
+        self.flow_field = None #the monsters' distance map to the player, made by initialize_fov
+        self.flow_origin = None #the player's position when the flow field was computed
+        self.game_time = 0 #in ticks, see TICKS_PER_SECOND
+        self.turn_queue = TurnQueue() #the monsters of the current level, by the time of their next turn
+        self.level_cache = LevelCache() #the levels the player left, and the next one, generated in the background
+        self.rng = dict((name, RandomStream(name)) for name in RANDOM_STREAMS) #the random streams, by name
+        self.run_seed = 0 #the seed of the game
+        self.recorder = None #the Replay of the game, if it's recorded
+        self.inventory_scans = 0 #how many times get_all_equipped walked the inventory (reading a stat must not)
+
+    def seed_streams(self, seed):
+        #start all the random streams of a run
+        self.run_seed = seed
+        for stream in self.rng.values():
+            stream.seed(seed)
+
+    def add_object(self, obj):
+        #put an object on the current level
+        self.objects.add(obj)
+        self.object_index.add(obj)
+        obj.clear()
+
+    def remove_object(self, obj):
+        #take an object off the current level
+        self.objects.remove(obj)
+        self.object_index.remove(obj)
+        obj.clear()
+
+    def is_blocked(self, x, y):
+        #first test the map tile, then check for any blocking objects on that tile
+        return self.map.is_blocked(x, y) or self.object_index.is_blocked(x, y)
+
+    def make_map(self):
+        #generate the current dungeon level right away
+        self.enter_level(generate_level(self.run_seed, self.dungeon_level, MAP_WIDTH, MAP_HEIGHT))
+
+    def enter_level(self, level):
+        #make a level the current one, with the player at its start
+        self.current_level = level
+        self.map = level.map
+        self.objects = level.objects
+        self.object_index = level.object_index
+        self.stairs = level.stairs
+        self.dirty_tiles = set()
+
+        player = self.player
+        (player.x, player.y) = level.start
+        self.objects.add(player)
+        self.object_index.add(player)
+        self.schedule_level()
+
+    def leave_level(self):
+        #take the player off the current level, and keep the level for later
+        self.objects.remove(self.player)
+        self.object_index.remove(self.player)
+        self.level_cache.store(self.current_level)
+
+    def change_level(self, depth):
+        #go to another dungeon level, generated ahead of time if possible, and start generating the one below
+        self.leave_level()
+        self.dungeon_level = depth
+        level = self.level_cache.get(self.run_seed, depth)
+        self.enter_level(level)
+        self.initialize_fov(level.fov_map)
+        self.level_cache.prefetch(self.run_seed, depth + 1)
+
+    def discard_levels(self):
+        #forget the levels of the previous game
+        self.level_cache.clear()
+        if self.current_level is not None:
+            self.current_level.delete()
+            self.current_level = None
+
+    def initialize_fov(self, fov = None):
+        #start using the FOV map of the current level (fov, if it was built ahead of time, or a new one)
+        tile_map = self.map
+        self.fov_recompute = True
+        self.fov_cells = new_tile_array(tile_map.width * tile_map.height, False) #nothing in view until it's computed
+
+        if fov is None:
+            fov = fov_maps.new(tile_map)
+        level = self.current_level
+        if level.fov_map is not None and level.fov_map != fov:
+            fov_maps.delete(level.fov_map)
+        level.fov_map = fov
+        self.fov_map = fov
+
+        #the monsters' distance map uses the same walkable tiles
+        if self.flow_field is not None:
+            libtcod.dijkstra_delete(self.flow_field)
+        self.flow_field = libtcod.dijkstra_new(fov, FLOW_DIAGONAL_COST)
+        self.flow_origin = None
+
+        if not headless:
+            libtcod.console_clear(con) #unexplored areas start black (default background color)
+        self.redraw_map()
+
+    def set_tile(self, x, y, blocked, block_sight = None):
+        #change a tile of the current level (e.g. a dug wall or an opened door), updating just its FOV cell
+        if block_sight is None:
+            block_sight = blocked
+        tile_map = self.map
+        i = y * tile_map.width + x
+        tile_map.blocked[i] = blocked
+        tile_map.block_sight[i] = block_sight
+        fov_maps.update_tile(self.fov_map, tile_map, x, y)
+
+        self.dirty_tiles.add((x, y))
+        self.fov_recompute = True
+        self.flow_origin = None #the monsters' paths may go through it now
+
+    def update_flow_field(self):
+        #compute the distance from every tile to the player, once per player move.
+        #all the monsters chasing the player share it
+        origin = (self.player.x, self.player.y)
+        if self.flow_origin != origin:
+            libtcod.dijkstra_compute(self.flow_field, origin[0], origin[1])
+            self.flow_origin = origin
+
+    def mark_dirty(self, x, y):
+        #remember that a map cell changed, so the next render_all repaints it
+        self.dirty_tiles.add((x, y))
+
+    def redraw_map(self):
+        #forget what is on the map console, so the next render_all repaints every cell
+        tile_map = self.map
+        self.visible_tiles = new_tile_array(tile_map.width * tile_map.height, False)
+        self.dirty_tiles.update((x, y) for y in range(tile_map.height) for x in range(tile_map.width))
+        self.panel_state = None
+
+    def in_fov(self, x, y):
+        #whether a tile was in view at the last FOV computation. a tile off the map (e.g. a click on the panel)
+        #never is, like with libtcod.map_is_in_fov
+        tile_map = self.map
+        if x < 0 or y < 0 or x >= tile_map.width or y >= tile_map.height:
+            return False
+        return self.fov_cells[y * tile_map.width + x]
+
+    def update_fov(self):
+        #recompute the FOV if needed, marking the cells that came into or went out of view
+        if not self.fov_recompute:
+            return
+        self.fov_recompute = False
+        player = self.player
+        libtcod.map_compute_fov(self.fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        fov_cells = self.fov_cells = libtcod.map_get_fov(self.fov_map)
+
+        #find the tiles that came into or went out of view, and mark them
+        visible = self.visible_tiles
+        explored = self.map.explored
+        width = self.map.width
+        dirty_tiles = self.dirty_tiles
+        objects_at = self.object_index.at
+        if libtcod.numpy_available:
+            changed = numpy.flatnonzero(fov_cells != visible).tolist()
+        else:
+            changed = [i for i in range(len(visible)) if fov_cells[i] != visible[i]]
+        for i in changed:
+            (y, x) = divmod(i, width)
+            visible[i] = fov_cells[i]
+            dirty_tiles.add((x, y))
+            if visible[i]: #since it's visible, explore it and wake up the monsters there
+                explored[i] = True
+                for obj in objects_at(x, y):
+                    if obj.asleep:
+                        self.wake_up(obj)
+
+    def end_turn(self, obj):
+        #an object acted, its next turn comes after the delay of that action (its speed or attack speed)
+        obj.next_turn = self.game_time + obj.wait + 1
+        obj.wait = 0
+
+    def schedule_level(self):
+        #start a level with all its monsters asleep, the ones in view will wake up when the FOV is computed
+        for obj in self.objects:
+            if obj.ai:
+                obj.asleep = True
+        self.turn_queue = TurnQueue(self.objects, self.game_time)
+
+    def wake_up(self, monster):
+        #a sleeping monster saw the player, got hurt or heard a noise: it takes turns again
+        if monster.asleep and monster.ai is not None:
+            monster.asleep = False
+            monster.ai.unseen_turns = 0
+            self.turn_queue.schedule(monster, max(monster.next_turn, self.game_time))
+
+    def make_noise(self, x, y, radius = NOISE_RADIUS):
+        #wake up the sleeping monsters that can hear a noise
+        for obj in self.objects:
+            if obj.asleep and obj.distance(x, y) <= radius:
+                self.wake_up(obj)
+
+    def advance_time(self, ticks):
+        #let the monsters act, in order, whose turns come in the next ticks of game time. the game time is
+        #kept up to date while they act, wake_up and end_turn read it
+        pop_due = self.turn_queue.pop_due
+        schedule = self.turn_queue.schedule
+        end = self.game_time + ticks
+        while True:
+            obj = pop_due(end)
+            if obj is None:
+                break
+            self.game_time = obj.next_turn
+            obj.ai.take_turn()
+            if obj.ai is not None and not obj.asleep:
+                self.end_turn(obj)
+                schedule(obj, obj.next_turn)
+        self.game_time = end
+
 #############
 # FUNCTIONS #
 #############
 
+def percentile(values, p):
+    #the p-th percentile of some numbers (nearest rank), 0 if there are none
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p * len(values) / 100.0)) - 1)]
+
 def get_equipped_in_slot(slot): #returns the equipment in a slot, or None if empty
-    for obj in inventory:
-        if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-            return obj.equipment
-    return None
+    return state.inventory.slots.get(slot)
 
 def get_all_equipped(obj): #returns a list of equipped items
-    if obj == player:
+    if obj == state.player:
+        state.inventory_scans += 1
         equipped_list = []
-        for item in inventory:
+        for item in state.inventory:
             if item.equipment and item.equipment.is_equipped:
                 equipped_list.append(item.equipment)
         return equipped_list
     else:
         return [] #other objects have no equipment
 
-def is_blocked(x, y):
-    #first test the map tile
-    if map[x][y].blocked:
-        return True
-    
-    #now check for any blocking objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
+NEIGHBOURS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+def update_flow_field():
+    state.update_flow_field()
 
-    return False
+def object_layer(obj):
+    #the drawing layer an object starts in: items below monsters, anything else (e.g. a corpse) below items
+    if obj.item:
+        return LAYER_ITEMS
+    if obj.fighter:
+        return LAYER_ACTORS
+    return LAYER_CORPSES
+
+def add_object(obj):
+    state.add_object(obj)
+
+def remove_object(obj):
+    state.remove_object(obj)
+
+def is_blocked(x, y):
+    return state.is_blocked(x, y)
 
-def create_room(room):
-    global map
+def create_room(tile_map, room):
     #go through the tiles in the rectangle and make them passable
     for x in range(room.x1 + 1, room.x2):
         for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+            tile_map.carve(x, y)
 
-def create_h_tunnel(x1, x2, y):
-    global map
+def create_h_tunnel(tile_map, x1, x2, y):
     for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        tile_map.carve(x, y)
 
-def create_v_tunnel(y1, y2, x):
+def create_v_tunnel(tile_map, y1, y2, x):
     for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        tile_map.carve(x, y)
 
-def make_map():
-    global map, objects, stairs
-
-    #list of objects
-    objects = [player]
+def generate_level(seed, depth, width, height):
+    #build a dungeon level from the seed of the game and the dungeon level alone. no globals are changed,
+    #so this can run in a background thread
+    level = Level(seed, depth, TileMap(width, height)) #fill map with blocked tiles
 
-    #fill map with blocked tiles
-    map = [[Tile(True)
-            for y in range(MAP_HEIGHT) ]
-               for x in range(MAP_WIDTH) ]
+    #the same seed and dungeon level always give the same level
+    map_rng = RandomStream('map')
+    map_rng.seed(seed, depth)
+    loot_rng = RandomStream('loot')
+    loot_rng.seed(seed, depth)
 
     rooms = []
     num_rooms = 0
 
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        (w, h) = map_rng.get_ints(ROOM_MIN_SIZE, ROOM_MAX_SIZE, 2)
         #random position without going outside of map boundaries
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = map_rng.get_int(0, width - w - 1)
+        y = map_rng.get_int(0, height - h - 1)
 
         new_room = Rect(x, y, w, h)
 
@@ -567,39 +1693,54 @@ def make_map():
                 break
 
         if not failed:
-            create_room(new_room)
-            place_objects(new_room)
+            create_room(level.map, new_room)
+            place_objects(level, new_room, map_rng, loot_rng)
 
             (new_x, new_y) = new_room.center()
 
-            if num_rooms == 0: #first room
-                player.x = new_x
-                player.y = new_y
+            if num_rooms == 0: #first room, where the player starts
+                level.start = (new_x, new_y)
 
             else: #all subsequent rooms
                 #center coordinates of previous room
                 (prev_x, prev_y) = rooms[num_rooms - 1].center()
 
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if map_rng.get_int(0, 1) == 1:
                     #horizontal, then vertical
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
+                    create_h_tunnel(level.map, prev_x, new_x, prev_y)
+                    create_v_tunnel(level.map, prev_y, new_y, new_x)
                 else:
                     #vertical, then horizontal
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+                    create_v_tunnel(level.map, prev_y, new_y, prev_x)
+                    create_h_tunnel(level.map, prev_x, new_x, new_y)
 
             #append new room to the list
             rooms.append(new_room)
             num_rooms += 1
 
     #create stairs at the center of the last room
-    stairs = Object(new_x, new_y, ladder_tile, 'ladder', libtcod.white, always_visible = True)
-    objects.append(stairs)
-    stairs.send_to_back() #so it's drawn below monsters
+    level.stairs = Object(new_x, new_y, ladder_tile, 'ladder', libtcod.white, always_visible = True,
+        layer = LAYER_STAIRS)
+    level.add(level.stairs)
+    return level
+
+def make_map():
+    state.make_map()
+
+def enter_level(level):
+    state.enter_level(level)
 
-def random_choice_index(chances): #choose one options from a list of chances and return its index
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+def leave_level():
+    state.leave_level()
+
+def change_level(depth):
+    state.change_level(depth)
+
+def discard_levels():
+    state.discard_levels()
+
+def random_choice_index(chances, stream): #choose one options from a list of chances and return its index
+    dice = stream.get_int(1, sum(chances))
 
     #go through all chances, keeping the sum so far
     running_sum = 0
@@ -612,81 +1753,77 @@ def random_choice_index(chances): #choose one options from a list of chances and
             return choice
         choice += 1
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, stream):
     #choose one option from a dictionary of chances, returning its key
     strings = chances_dict.keys()
     chances = chances_dict.values()
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, stream)]
 
-def from_dungeon_level(table):
+def from_dungeon_level(table, depth):
     #returns value that corresponds to a level
     #table specifies what value occurs at what level, default is zero
     for (value, level) in reversed(table):
-        if dungeon_level >= level:
+        if depth >= level:
             return value
     return 0
 
-def place_objects(room):
+def place_objects(level, room, map_rng, loot_rng):
 
     #maximum number of monsters per room
-    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
+    max_monsters = from_dungeon_level(MAX_MONSTERS, level.depth)
 
     #monster probability distribution
     monster_chances = {}
-    monster_chances['orc'] = 80
-    monster_chances['troll'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
+    for name in ['orc', 'troll']:
+        monster_chances[name] = from_dungeon_level(MONSTER_CHANCES[name], level.depth)
 
     #choose random number of monsters
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+    num_monsters = map_rng.get_int(0, max_monsters)
 
     for i in range(num_monsters):
         #choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = map_rng.get_int(room.x1 + 1, room.x2 - 1)
+        y = map_rng.get_int(room.y1 + 1, room.y2 - 1)
 
-        if not is_blocked(x, y):
-            choice = random_choice(monster_chances)
+        if not level.is_blocked(x, y):
+            choice = random_choice(monster_chances, map_rng)
             if choice == 'orc':
                 #create and orc
-                fighter_component = Fighter(hp = 20, defense = 0, power = 4, xp = 35, death_function = monster_death)
+                fighter_component = Fighter(death_function = monster_death, **MONSTER_STATS['orc'])
                 ai_component = BasicMonster()
 
                 monster = Object(x, y, orc_tile, 'orc', libtcod.white,
                     blocks = True, fighter = fighter_component, ai = ai_component)
             elif choice == 'troll':
                 #create a troll
-                fighter_component = Fighter(hp = 30, defense = 2, power = 8, xp = 100, death_function = monster_death)
+                fighter_component = Fighter(death_function = monster_death, **MONSTER_STATS['troll'])
                 ai_component = BasicMonster()
                 
                 monster = Object(x, y, troll_tile, 'troll', libtcod.white,
                     blocks = True, fighter = fighter_component, ai = ai_component)
 
-            objects.append(monster)
+            level.add(monster)
 
     #maximum number of items per room
-    max_items = from_dungeon_level([[1, 1], [2, 4]])
+    max_items = from_dungeon_level(MAX_ITEMS, level.depth)
 
     #item probabilty distribution
     item_chances = {}
-    item_chances['heal'] = 35
-    item_chances['lightning'] = from_dungeon_level([[25, 4]])
-    item_chances['fireball'] = from_dungeon_level([[25, 6]])
-    item_chances['confuse'] = from_dungeon_level([[10, 2]])
-    item_chances['sword'] = from_dungeon_level([[5, 4]])
-    item_chances['shield'] = from_dungeon_level([[15, 8]])
+    for name in ['heal', 'lightning', 'fireball', 'confuse', 'sword', 'shield']:
+        item_chances[name] = from_dungeon_level(ITEM_CHANCES[name], level.depth)
 
     #choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = loot_rng.get_int(0, max_items)
 
     for i in range(num_items):
         #choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = loot_rng.get_int(room.x1 + 1, room.x2 - 1)
+        y = loot_rng.get_int(room.y1 + 1, room.y2 - 1)
 
         #only place if the tile is not blocked
-        if not is_blocked(x, y):
-            choice = random_choice(item_chances)
+        if not level.is_blocked(x, y):
+            choice = random_choice(item_chances, loot_rng)
             if choice == 'heal':
                 #create a healing potion
                 item_component = Item(use_function = cast_heal)
@@ -717,8 +1854,7 @@ def place_objects(room):
                 equipment_component = Equipment(slot = 'left hand', defense_bonus = 1)
                 item = Object(x, y, wood_shield_tile, 'sheild', libtcod.white, equipment = equipment_component)
           
-            objects.append(item)
-            item.send_to_back() #items appear below other objects
+            level.add(item)
             item.always_visible = True #items are visible even out of FOV, if in an explored area
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color, display = 'default_display'):
@@ -750,55 +1886,109 @@ def get_names_under_mouse():
     (x, y) = (mouse.cx, mouse.cy)
 
     #create a list with the names of all objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in objects
-             if obj.x == x and obj.y ==y and (libtcod.map_is_in_fov(fov_map, obj.x, obj.y) or (obj.always_visible and map[obj.x][obj.y].explored))]
+    names = [obj.name for obj in state.object_index.at(x, y)
+             if (state.in_fov(obj.x, obj.y) or (obj.always_visible and state.map.is_explored(obj.x, obj.y)))]
 
     names = ', '.join(names) #join names, separated by commas
     return names.capitalize()
 
-def render_all():
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute
-    global game_msgs
-    global hotkeys 
-    global hot_chars
-    global hot_types
-
-    if fov_recompute:
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        #go through all tiles and set their background color according to FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = libtcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
-                if not visible:
-                    #if it's not visible right now, the player can only see it if it's explored
-                    if map[x][y].explored:
-                        if wall:
-                            libtcod.console_put_char_ex(con, x, y, wall_tile, libtcod.grey, color_dark_wall)
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-                else:
-                    #it's visible
-                    if wall:
-                        libtcod.console_put_char_ex(con, x, y, wall_tile, libtcod.white, color_light_wall)
-                    else:
-                        libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-                    #since it's visible, explore it
-                    map[x][y].explored = True
-                            
-    #draw all objects in the list, except the player
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
+def mark_dirty(x, y):
+    state.mark_dirty(x, y)
 
-    #blit the contents of "con" to the root console
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+def redraw_map():
+    state.redraw_map()
 
+def draw_tile(x, y):
+    #paint a single map cell according to FOV and exploration, erasing whatever was drawn there
+    tile_map = state.map
+    i = y * tile_map.width + x
+    wall = tile_map.block_sight[i]
+    if state.visible_tiles[i]:
+        if wall:
+            libtcod.console_put_char_ex(con, x, y, wall_tile, libtcod.white, color_light_wall)
+        else:
+            libtcod.console_put_char_ex(con, x, y, ' ', libtcod.white, color_light_ground)
+    elif tile_map.explored[i]:
+        #if it's not visible right now, the player can only see it if it's explored
+        if wall:
+            libtcod.console_put_char_ex(con, x, y, wall_tile, libtcod.grey, color_dark_wall)
+        else:
+            libtcod.console_put_char_ex(con, x, y, ' ', libtcod.white, color_dark_ground)
+    else:
+        libtcod.console_put_char_ex(con, x, y, ' ', libtcod.black, libtcod.black)
+
+def fill_map_console():
+    #paint every map cell at once: compute the char, foreground and background layers as arrays,
+    #then hand them to libtcod in three calls
+    tile_map = state.map
+    visible = state.visible_tiles
+    explored = tile_map.explored
+    wall = tile_map.block_sight
+
+    if libtcod.numpy_available:
+        seen_wall = explored & wall
+        back = numpy.zeros((tile_map.width * tile_map.height, 3), dtype = numpy.intc) #unexplored cells stay black
+        back[explored & ~wall] = tuple(color_dark_ground)
+        back[seen_wall] = tuple(color_dark_wall)
+        back[visible & ~wall] = tuple(color_light_ground)
+        back[visible & wall] = tuple(color_light_wall)
+        fore = numpy.zeros((tile_map.width * tile_map.height, 3), dtype = numpy.intc)
+        fore[explored] = tuple(libtcod.white)
+        fore[seen_wall & ~visible] = tuple(libtcod.grey)
+        chars = numpy.where(seen_wall, wall_tile, ord(' '))
+        libtcod.console_fill_background(con, back[:, 0], back[:, 1], back[:, 2])
+        libtcod.console_fill_foreground(con, fore[:, 0], fore[:, 1], fore[:, 2])
+        libtcod.console_fill_char(con, chars)
+    else:
+        #look up the (background, foreground, char) of each cell in a small palette:
+        #0 = unexplored, 1 = explored ground, 2 = explored wall, 3 = visible ground, 4 = visible wall
+        palette = [(libtcod.black, libtcod.black, ord(' ')),
+            (color_dark_ground, libtcod.white, ord(' ')),
+            (color_dark_wall, libtcod.grey, wall_tile),
+            (color_light_ground, libtcod.white, ord(' ')),
+            (color_light_wall, libtcod.white, wall_tile)]
+        cells = [palette[explored[i] and 1 + (1 if wall[i] else 0) + (2 if visible[i] else 0)]
+            for i in range(tile_map.width * tile_map.height)]
+        libtcod.console_fill_background(con, [back.r for (back, fore, char) in cells],
+            [back.g for (back, fore, char) in cells], [back.b for (back, fore, char) in cells])
+        libtcod.console_fill_foreground(con, [fore.r for (back, fore, char) in cells],
+            [fore.g for (back, fore, char) in cells], [fore.b for (back, fore, char) in cells])
+        libtcod.console_fill_char(con, [char for (back, fore, char) in cells])
+
+def in_fov(x, y):
+    return state.in_fov(x, y)
+
+def update_fov():
+    state.update_fov()
+
+def render_map():
+    #repaint only the map cells that changed since the last frame
+    update_fov()
+
+    dirty_tiles = state.dirty_tiles
+    if len(dirty_tiles) >= BULK_RENDER_THRESHOLD:
+        #so much changed that it's cheaper to repaint everything in bulk, then draw all objects on top, layer
+        #by layer (the player last)
+        fill_map_console()
+        for object in state.objects:
+            object.draw()
+    else:
+        #repaint the changed cells, then the objects standing on them, in the order of their layers
+        objects_at = state.object_index.at
+        for (x, y) in dirty_tiles:
+            draw_tile(x, y)
+            for object in objects_at(x, y):
+                object.draw()
+    dirty_tiles.clear()
+
+def get_panel_state():
+    #everything the GUI panel shows. the panel is only rebuilt when this changes
+    player = state.player
+    return (player.fighter.hp, player.fighter.max_hp, player.fighter.xp, player.level, player.fighter.god_mode,
+        state.dungeon_level, state.game_msgs, state.game_msgs.version, state.inventory, state.inventory.version,
+        tuple(state.hotkeys), get_names_under_mouse())
+
+def render_panel():
     #prepare to render the GUI panel
     libtcod.console_set_default_background(panel, libtcod.black)
     libtcod.console_clear(panel)
@@ -809,19 +1999,20 @@ def render_all():
     
     i = 0
     for k in HOTKEY_OPTIONS:
-        for hot in hotkeys:
+        for hot in state.hotkeys:
             if k == hot.button:
                 hot.render_gui(BAR_WIDTH + 2, i + 3, str(i + 1))
         i += 1
             
-    #print the game messages, one line at a time
+    #print the last game messages, one line at a time
     y = 2
-    for (line, color) in game_msgs:
+    for (line, color) in state.game_msgs.last_lines(MSG_WIDTH, MSG_HEIGHT):
         libtcod.console_set_default_foreground(panel, color)
         libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
         y += 1
 
     #show the player's stats
+    player = state.player
     if player.fighter.god_mode:
         render_bar(1, 2, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp,
             libtcod.dark_red, libtcod.black, 'GOD MODE ACTIVATED')
@@ -833,38 +2024,87 @@ def render_all():
     if player.fighter.god_mode is False:
         render_bar(1, 0, 78, 'XP', player.fighter.xp, level_up_xp, libtcod.green, libtcod.dark_gray, 'LEVEL ' + str(player.level))
 
-    libtcod.console_print_ex(panel, 1, 5, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon Level ' + str(dungeon_level))
+    libtcod.console_print_ex(panel, 1, 5, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon Level ' + str(state.dungeon_level))
 
     #display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_gray)
     libtcod.console_print_ex(panel, 1, 4, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
 
+def render_all():
+    if headless: #nothing to draw on
+        return
+
+    render_map()
+
+    #blit the contents of "con" to the root console
+    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+
+    #rebuild the GUI panel only if something on it changed
+    new_panel_state = get_panel_state()
+    if new_panel_state != state.panel_state:
+        state.panel_state = new_panel_state
+        render_panel()
+
+    #the profiling overlay replaces the messages
+    if profiler is not None and profiler.overlay:
+        profiler.render(panel, MSG_X, 1, MSG_WIDTH, PANEL_HEIGHT - 1)
+
     #blit contents of panel to root console
     libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 
 def message(new_msg, color = libtcod.white):
-    #split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
-
-    for line in new_msg_lines:
-        #if the buffer is full, remove the first line to make room for a new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+    #add a message to the log, it is split among multiple lines when shown
+    state.game_msgs.add(new_msg, color)
+
+def show_message_log():
+    #show the message history over the map, scrolled with the arrow and page keys, until another key is pressed
+    if headless:
+        return
+    window = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    width = MAP_WIDTH - 2
+    height = MAP_HEIGHT - 2
+    skip = 0 #lines scrolled back from the last one
+    while not libtcod.console_is_window_closed():
+        total = state.game_msgs.count_lines(width)
+        skip = max(0, min(skip, total - height))
+        libtcod.console_set_default_background(window, libtcod.black)
+        libtcod.console_clear(window)
+        libtcod.console_set_default_foreground(window, libtcod.white)
+        libtcod.console_print_frame(window, 0, 0, MAP_WIDTH, MAP_HEIGHT, False, libtcod.BKGND_NONE,
+            'Messages (%d-%d of %d)' % (max(1, total - skip - height + 1), total - skip, total))
+        y = 1
+        for (line, color) in state.game_msgs.last_lines(width, height, skip):
+            libtcod.console_set_default_foreground(window, color)
+            libtcod.console_print_ex(window, 1, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            y += 1
+        libtcod.console_blit(window, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+        libtcod.console_flush()
 
-        #add the new line as a tuple with the text and the color
-        game_msgs.append( (line, color) )
+        #wait for a key, like menu() does
+        key.vk = libtcod.KEY_NONE
+        libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS, key, mouse, True)
+        if key.vk in (libtcod.KEY_UP, libtcod.KEY_KP8):
+            skip += 1
+        elif key.vk in (libtcod.KEY_DOWN, libtcod.KEY_KP2):
+            skip -= 1
+        elif key.vk in (libtcod.KEY_PAGEUP, libtcod.KEY_KP9):
+            skip += height
+        elif key.vk in (libtcod.KEY_PAGEDOWN, libtcod.KEY_KP3):
+            skip -= height
+        elif key.vk != libtcod.KEY_NONE:
+            break
+    libtcod.console_delete(window)
 
 def player_move_or_attack(dx, dy):
-    global fov_recompute
-
     #coordinates the player is trying to move to or attack
+    player = state.player
     x = player.x + dx
     y = player.y + dy
 
     #try to find an attackable object there
     target = None
-    for object in objects:
-        if object.fighter and object.x ==x and object.y ==y:
+    for object in state.object_index.at(x, y):
+        if object.fighter:
             target = object
             break
 
@@ -874,13 +2114,16 @@ def player_move_or_attack(dx, dy):
 
     else:
         player.move(dx, dy)
-        fov_recompute = True
+        state.fov_recompute = True
 
 def menu(header, options, width):
     global key, window
     
     if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
 
+    if headless:
+        return recorded_choice(input_source.choose(header, options), options)
+
     #calculate total height for header (after auto-wrap) and one line per option
     header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
     if header == '':
@@ -911,27 +2154,38 @@ def menu(header, options, width):
     libtcod.console_flush()
 
     while True:
-        #check for input in each iteration
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
+        #sleep until a key is pressed (mouse events don't wake it up), forgetting the keys pressed before the
+        #menu was shown. the menu stays on the screen meanwhile, nothing has to be redrawn
+        key.vk = libtcod.KEY_NONE
+        libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS, key, mouse, True)
+        if libtcod.console_is_window_closed():
+            return None
 
         index = key.c - ord('a')
-        if key.vk == libtcod.KEY_NONE: continue #if nothing is pressed keep looping
+        if key.vk == libtcod.KEY_NONE: continue #not a key press, keep waiting
 
         elif key.vk == libtcod.KEY_ENTER and key.lalt:
             #Alt+Enter: toggle fullscreen
             libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
+            libtcod.console_flush()
 
-        elif index >= 0 and index < len(options): return index #if an option is chosen return it's index in the options list
+        elif index >= 0 and index < len(options): return recorded_choice(index, options) #if an option is chosen return it's index in the options list
 
-        elif index < 0 or index >= len(options): return None #if any other key is pressed close the menu
+        elif index < 0 or index >= len(options): return recorded_choice(None, options) #if any other key is pressed close the menu
+
+def recorded_choice(index, options):
+    #keep a menu choice in the replay of the game (a msgbox has no options, nothing to play again)
+    if state.recorder is not None and options:
+        state.recorder.record_choice(index)
+    return index
         
 def OLD_inventory_menu(header): #OBSOLETE, here for nostalgia
     #show a menu with each item of the inventory as an option
-    if len(inventory) == 0:
+    if len(state.inventory) == 0:
         options = ['Inventory is empty.']
     else:
         options = []
-        for item in inventory:
+        for item in state.inventory:
             text = item.name
             #show additional info, in case it's equipped
             if item.equipment and item.equipment.is_equipped:
@@ -941,49 +2195,40 @@ def OLD_inventory_menu(header): #OBSOLETE, here for nostalgia
     index = menu(header, options, INVENTORY_WIDTH)
 
     #if an item was chosen, return it
-    if index is None or len(inventory) == 0: return None
-    return inventory[index].item
+    if index is None or len(state.inventory) == 0: return None
+    return state.inventory[index].item
 
 def inventory_menu(header):
     #show a menu with each item of the inventory as an option
-    if len(inventory) == 0:
+    if len(state.inventory) == 0:
         options = ['Inventory is empty.']
     else:
-        options = []
-        for k in inventory_dict.keys():
+        #one option per label, as (text, label)
+        choices = []
+        for (k, stack) in state.inventory.stacks.items():
             text = k
-            if isinstance(inventory_dict[k], int) and inventory_dict[k] > 1:
-                text = k + ' (' + str(inventory_dict[k]) + ')'
-            if isinstance(inventory_dict[k], str) and inventory_dict[k] != 'unequipped':
-                i = 0
-                while inventory[i].label != k:
-                    i += 1
-                item = inventory[i]
-                text = text + ' (on ' + item.equipment.slot + ')'
-                
-            options.append(text)
-
-    options = sorted(options)
+            if isinstance(stack, int) and stack > 1:
+                text = k + ' (' + str(stack) + ')'
+            if isinstance(stack, str) and stack != 'unequipped':
+                text = text + ' (on ' + stack + ')'
+            choices.append((text, k))
+        choices.sort()
+        options = [text for (text, k) in choices]
 
     index = menu(header, options, INVENTORY_WIDTH)
     
-    if index is None or len(inventory) == 0: return None
-        
-    i = 0
-    item_type = options[index]
-    chosen_item = inventory[i]
-    while inventory[i].label != item_type[:len(inventory[i].label)].lower():
-        i += 1
-        chosen_item = inventory[i]
+    if index is None or len(state.inventory) == 0: return None
     
-    return chosen_item.item
+    return state.inventory.first(choices[index][1]).item
 
 def msgbox(text, width = 50):
+    if headless: #nobody to show it to
+        return
     menu(text, [], width) #use menu() as a sort of message box
     
 def handle_keys():
     global key
-    global hotkeys
+    player = state.player
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         #alt+enter toggles fullscreen
@@ -995,10 +2240,9 @@ def handle_keys():
     elif key.vk == libtcod.KEY_TAB:
         player.fighter.toggle_god_mode()
 
-    if game_state == 'playing':
+    if state.game_state == 'playing':
 
-        if player.wait > 0: #don't take a turn yet if still waiting
-            player.wait -= 1
+        if player.next_turn > state.game_time: #don't take a turn yet if still waiting
             return
         
         #movement keys with num pad support
@@ -1026,8 +2270,9 @@ def handle_keys():
             
             #check for hotkey press (press 5 for manual configuration)
             if key.vk in HOTKEY_OPTIONS or key.vk == libtcod.KEY_5:
-                if key.vk == libtcod.KEY_5 or len(hotkeys) == 0 or (key.vk not in [h.button for h in hotkeys]):
-                    hotkeys = []
+                if (key.vk == libtcod.KEY_5 or len(state.hotkeys) == 0 or
+                    (key.vk not in [h.button for h in state.hotkeys])):
+                    state.hotkeys = []
                     render_all()
                     i = 1
                     for k in HOTKEY_OPTIONS:
@@ -1035,20 +2280,21 @@ def handle_keys():
                         if item_component is not None:
                             new_hotkey = Hotkey(k, item_component.owner)
                             new_hotkey.configure()
-                        libtcod.console_clear(window)
+                        if not headless:
+                            libtcod.console_clear(window)
                         render_all()
                         i += 1
                 
-                elif key.vk in [h.button for h in hotkeys]:
-                    for hot in hotkeys:
+                elif key.vk in [h.button for h in state.hotkeys]:
+                    for hot in state.hotkeys:
                         if hot.button == key.vk:
                             hot.use()
             
             #test for other keys
             elif key_char == 'g':
                 #pick up an item
-                for object in objects: #look for an item in the player's tile
-                    if object.x == player.x and object.y ==player.y and object.item:
+                for object in state.object_index.at(player.x, player.y): #look for an item in the player's tile
+                    if object.item:
                         object.item.pick_up()
                         break
 
@@ -1066,7 +2312,7 @@ def handle_keys():
 
             elif key_char == 's':
                 #go down stairs, if the player is on them
-                if (stairs.x == player.x and stairs.y == player.y) or player.fighter.god_mode:
+                if (state.stairs.x == player.x and state.stairs.y == player.y) or player.fighter.god_mode:
                     next_level()
 
             elif key_char == 'c':
@@ -1077,9 +2323,13 @@ def handle_keys():
                     '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense),
                     CHARACTER_SCREEN_WIDTH)
 
+            elif key_char == 'm':
+                #show the older messages
+                show_message_log()
+
             elif key_char == 'h':
                 strings = ''
-                for element in [h.prompt for h in hotkeys]:
+                for element in [h.prompt for h in state.hotkeys]:
                     strings = strings + element
                 
                 msgbox('Hotkeys\n\n' + strings, 30)
@@ -1088,6 +2338,7 @@ def handle_keys():
 
 def check_level_up():
     #see if the player's experience is enough to level-up
+    player = state.player
     level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
     if player.fighter.xp >= level_up_xp:
         #level up and raise some stats
@@ -1096,7 +2347,7 @@ def check_level_up():
         message('Your battle skills grow stronger! You reached level ' + str(player.level) + '!', libtcod.yellow)
 
         choice = None
-        while choice == None: #keep asking until a choice is made
+        while choice == None and (headless or not libtcod.console_is_window_closed()): #keep asking until a choice is made
             choice = menu('\nLEVEL UP! Choose a stat to raise:\n',
                 ['Constitution (+20 HP, currently ' + str(player.fighter.max_hp) + ')',
                 'Strength (+1 Attack, currently ' + str(player.fighter.power) + ')',
@@ -1112,17 +2363,17 @@ def check_level_up():
 
 def player_death(player):
     #the game ended!
-    global game_state
     message('You died!', libtcod.red)
-    game_state = 'dead'
+    state.game_state = 'dead'
 
     #for added effect, transform the player into the corpse!
     player.char = dead_mage_tile
     player.color = libtcod.dark_red
+    player.clear()
 
 def monster_death(monster):
     #transform it into a nasty corpse! it doesn't block, can't be attacked, and doesn't move
-    if player.fighter.god_mode:
+    if state.player.fighter.god_mode:
         message(monster.name.capitalize() + ' is dead!', libtcod.orange)
     else:
         message(monster.name.capitalize() + ' is dead! You gain ' + str(monster.fighter.xp) + ' XP.', libtcod.orange)
@@ -1138,24 +2389,42 @@ def monster_death(monster):
     monster.ai = None
     monster.name = 'remains of ' + monster.name
 
-    monster.send_to_back()
+    monster.set_layer(LAYER_CORPSES) #drawn below everything else
 
 def target_tile(max_range = None):
     #return the position of a tile left-clicked in player's FOV (optionally in a range), or (None, None) if right-clicked
     global key, mouse
+    if headless:
+        return recorded_target(input_source.target(max_range))
+
+    shown = None #the mouse cell the screen was last rendered for
     while True:
-        #render the screen. this erases the inventory and shows the names of objects under the mouse
-        libtcod.console_flush()
         libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
-        render_all()
+        if libtcod.console_is_window_closed():
+            return (None, None)
 
         (x, y) = (mouse.cx, mouse.cy)
-
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and (max_range is None or player.distance(x, y) <= max_range)):
-            return (x, y)
+        if (x, y) != shown:
+            #render the screen. the first time this erases the inventory, then it updates the names of
+            #objects under the mouse
+            shown = (x, y)
+            render_all()
+            libtcod.console_flush()
+        elif key.vk == libtcod.KEY_NONE and not (mouse.lbutton_pressed or mouse.rbutton_pressed):
+            #sys_wait_for_event only wakes up on keys, so poll the mouse, but no faster than the frame rate
+            libtcod.sys_sleep_milli(1000 // LIMIT_FPS)
+
+        if (mouse.lbutton_pressed and in_fov(x, y) and (max_range is None or state.player.distance(x, y) <= max_range)):
+            return recorded_target((x, y))
 
         if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
-            return (None, None) #cancel if the player right-clicks or presses ESCAPE
+            return recorded_target((None, None)) #cancel if the player right-clicks or presses ESCAPE
+
+def recorded_target(tile):
+    #keep a targeted tile in the replay of the game
+    if state.recorder is not None:
+        state.recorder.record_target(*tile)
+    return tile
 
 def target_monster(max_range = None):
     #returns a clicked monster inside FOV up to a range, or None if right-clicked
@@ -1165,8 +2434,8 @@ def target_monster(max_range = None):
             return None
 
         #return the first clicked monster, otherwise continue looping
-        for obj in objects:
-            if obj.x == x and obj.y ==y and obj.fighter and obj != player:
+        for obj in state.object_index.at(x, y):
+            if obj.fighter and obj != state.player:
                 return obj
 
 def closest_monster(max_range):
@@ -1174,10 +2443,10 @@ def closest_monster(max_range):
     closest_enemy = None
     closest_dist = max_range + 1
 
-    for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+    for object in state.objects:
+        if object.fighter and not object == state.player and in_fov(object.x, object.y):
             #calculate distance between this object and the player
-            dist = player.distance_to(object)
+            dist = state.player.distance_to(object)
             if dist < closest_dist: #it's closer, so remember it
                 closest_enemy = object
                 closest_dist = dist
@@ -1185,12 +2454,12 @@ def closest_monster(max_range):
 
 def cast_heal():
     #heal the player
-    if player.fighter.hp == player.fighter.max_hp:
+    if state.player.fighter.hp == state.player.fighter.max_hp:
         message('You are already at full health.', libtcod.light_violet)
         return 'cancelled'
 
     message('Your wounds start to heal!', libtcod.light_violet)
-    player.fighter.heal(HEAL_AMOUNT)
+    state.player.fighter.heal(HEAL_AMOUNT)
 
 def cast_lightning():
     #find closest enemy in range and damage it
@@ -1211,7 +2480,7 @@ def cast_fireball():
     if x is None: return 'cancelled'
     message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', libtcod.orange)
 
-    for obj in objects: #damage every fighter in range, including the player
+    for obj in list(state.objects): #damage every fighter in range, including the player (the dead change layer)
         if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
             message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.orange)
             obj.fighter.take_damage(FIREBALL_DAMAGE)
@@ -1227,126 +2496,605 @@ def cast_confuse():
     monster.ai.owner = monster #tell the new component who owns it
     message('The eyes of the ' +monster.name + ' look vacant, as he starts to stumble around!', libtcod.light_blue)
 
-def save_game():
-    #open a new empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player) #index of player in objects list
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
-    file['dungeon_level'] = dungeon_level
+###################
+# SAVEGAME FORMAT #
+###################
+
+#a savegame is a header, a directory of sections, and the sections themselves (each one zlib-compressed
+#if the header says so). strings are stored once, in the string table, and referenced by index (-1 = none)
+SAVE_HEADER = struct.Struct('<4sHHH') #magic, version, flags, number of sections
+SAVE_SECTION = struct.Struct('<4sII') #name, offset in the file, length in the file
+SAVE_ZLIB = 1 #header flag
+
+SAVE_INFO = struct.Struct('<hhhiii') #dungeon level, map width and height, player and stairs index, game state
+SAVE_MESSAGE = struct.Struct('<iBBB') #text, color
+SAVE_HOTKEY = struct.Struct('<ii') #button, index in the inventory
+REPLAY_EVENT = struct.Struct('<iBhh') #frame, kind, key command (in the string table), option or x, y
+SAVE_OBJECT = struct.Struct('<hhHiBBBHhhih' #x, y, char, name, color, flags, speed, ticks to the next turn, label, level
+    'iihhiih' #fighter: hp, base max hp, base defense, base power, xp, death function, attack speed
+    'BBh' #ai, previous ai of a confused monster, confused turns left
+    'i' #item: use function
+    'ihhh') #equipment: slot, power bonus, defense bonus, max hp bonus
+
+#object record flags
+SAVE_BLOCKS = 1
+SAVE_ALWAYS_VISIBLE = 2
+SAVE_FIGHTER = 4
+SAVE_ITEM = 8
+SAVE_EQUIPMENT = 16
+SAVE_GOD_MODE = 32
+SAVE_EQUIPPED = 64
+SAVE_LEVEL = 128
+
+#replay event kinds
+REPLAY_KEY = 0
+REPLAY_MENU = 1
+REPLAY_TARGET = 2
+
+#AI kinds
+SAVE_NO_AI = 0
+SAVE_BASIC_AI = 1
+SAVE_CONFUSED_AI = 2
+
+#functions that can be referenced by a savegame, by name
+SAVED_FUNCTIONS = dict((function.__name__, function) for function in
+    [player_death, monster_death, cast_heal, cast_lightning, cast_fireball, cast_confuse])
+
+def to_text(data):
+    #the string table holds UTF-8 bytes, the game uses native strings
+    if str is bytes:
+        return data
+    return data.decode('utf-8')
+
+class StringTable:
+    #the strings of a savegame, each stored once
+    def __init__(self, strings = ()):
+        self.strings = list(strings)
+        self.indexes = dict((text, i) for (i, text) in enumerate(self.strings))
+
+    def add(self, text):
+        #returns the index of a string, adding it if needed (None is stored as -1)
+        if text is None:
+            return -1
+        if text not in self.indexes:
+            self.indexes[text] = len(self.strings)
+            self.strings.append(text)
+        return self.indexes[text]
+
+    def get(self, index):
+        if index < 0:
+            return None
+        return self.strings[index]
+
+    def pack(self):
+        data = [struct.pack('<I', len(self.strings))]
+        for text in self.strings:
+            encoded = text.encode('utf-8')
+            data.append(struct.pack('<H', len(encoded)))
+            data.append(encoded)
+        return b''.join(data)
+
+    @classmethod
+    def unpack(cls, data):
+        (count,) = struct.unpack_from('<I', data, 0)
+        position = 4
+        strings = []
+        for i in range(count):
+            (length,) = struct.unpack_from('<H', data, position)
+            position += 2
+            strings.append(to_text(data[position:position + length]))
+            position += length
+        return cls(strings)
+
+class SaveFile:
+    #an open savegame. only the header and the directory are read when opening it, each section is read
+    #and decompressed the first time it's asked for
+    def __init__(self, filename, file_magic = SAVE_MAGIC):
+        self.file = open(filename, 'rb')
+        (magic, version, flags, count) = SAVE_HEADER.unpack(self.file.read(SAVE_HEADER.size))
+        if magic != file_magic:
+            self.file.close()
+            raise ValueError(filename + ' is not a savegame.')
+        if version != SAVE_VERSION:
+            self.file.close()
+            raise ValueError('Unsupported savegame version ' + str(version) + '.')
+        self.compressed = flags & SAVE_ZLIB
+        self.directory = {}
+        for i in range(count):
+            (name, offset, length) = SAVE_SECTION.unpack(self.file.read(SAVE_SECTION.size))
+            self.directory[name] = (offset, length)
+        self.sections = {}
+        self.string_table = None
+
+    def section(self, name):
+        if name not in self.sections:
+            (offset, length) = self.directory[name]
+            self.file.seek(offset)
+            data = self.file.read(length)
+            if self.compressed:
+                data = zlib.decompress(data)
+            self.sections[name] = data
+        return self.sections[name]
+
+    def strings(self):
+        if self.string_table is None:
+            self.string_table = StringTable.unpack(self.section(b'STRS'))
+        return self.string_table
+
+    def records(self, name, record):
+        #unpack a section made of a count and fixed-width records
+        data = self.section(name)
+        (count,) = struct.unpack_from('<I', data, 0)
+        return [record.unpack_from(data, 4 + i * record.size) for i in range(count)]
+
+    def close(self):
+        self.file.close()
+
+def write_save_file(filename, sections, compress = SAVE_COMPRESS, magic = SAVE_MAGIC):
+    #write the header, the directory and the (name, data) sections (replays use the same format)
+    if compress:
+        sections = [(name, zlib.compress(data)) for (name, data) in sections]
+    offset = SAVE_HEADER.size + SAVE_SECTION.size * len(sections)
+    parts = [SAVE_HEADER.pack(magic, SAVE_VERSION, SAVE_ZLIB if compress else 0, len(sections))]
+    for (name, data) in sections:
+        parts.append(SAVE_SECTION.pack(name, offset, len(data)))
+        offset += len(data)
+    parts.extend(data for (name, data) in sections)
+    file = open(filename, 'wb')
+    file.write(b''.join(parts))
+    file.close()
+
+def is_save_file(filename):
+    #True for a savegame in the compact format, False for an old shelve savegame (which may be stored
+    #under another file name, depending on the dbm module)
+    if not os.path.isfile(filename):
+        return False
+    file = open(filename, 'rb')
+    magic = file.read(len(SAVE_MAGIC))
+    file.close()
+    return magic == SAVE_MAGIC
+
+def pack_records(records, record):
+    return struct.pack('<I', len(records)) + b''.join(record.pack(*fields) for fields in records)
+
+def pack_bits(values):
+    #pack an array of booleans into a bitplane, 8 tiles per byte
+    if libtcod.numpy_available:
+        return numpy.packbits(numpy.asarray(values, dtype = numpy.bool_)).tobytes()
+    data = bytearray((len(values) + 7) // 8)
+    for i in range(len(values)):
+        if values[i]:
+            data[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(data)
+
+def unpack_bits(data, tiles):
+    #fill an array of booleans from a bitplane
+    if libtcod.numpy_available:
+        tiles[:] = numpy.unpackbits(numpy.frombuffer(data, dtype = numpy.uint8))[:len(tiles)]
+        return
+    data = bytearray(data)
+    for i in range(len(tiles)):
+        tiles[i] = (data[i >> 3] >> (7 - (i & 7))) & 1
+
+def ai_kind(ai):
+    if ai is None:
+        return SAVE_NO_AI
+    if isinstance(ai, ConfusedMonster):
+        return SAVE_CONFUSED_AI
+    return SAVE_BASIC_AI
+
+def object_record(obj, strings):
+    #the fixed-width record of an object and its components
+    flags = 0
+    if obj.blocks: flags |= SAVE_BLOCKS
+    if obj.always_visible: flags |= SAVE_ALWAYS_VISIBLE
+    if hasattr(obj, 'level'): flags |= SAVE_LEVEL
+
+    fighter = (0, 0, 0, 0, 0, -1, 0)
+    if obj.fighter:
+        flags |= SAVE_FIGHTER
+        if obj.fighter.god_mode: flags |= SAVE_GOD_MODE
+        f = obj.fighter
+        death_function = f.death_function.__name__ if f.death_function else None
+        fighter = (f.hp, f.base_max_hp, f.base_defense, f.base_power, f.xp, strings.add(death_function), f.attack_speed)
+
+    ai = (ai_kind(obj.ai), SAVE_NO_AI, 0)
+    if isinstance(obj.ai, ConfusedMonster):
+        ai = (SAVE_CONFUSED_AI, ai_kind(obj.ai.old_ai), obj.ai.num_turns)
+
+    item = (-1,)
+    if obj.item:
+        flags |= SAVE_ITEM
+        use_function = obj.item.use_function.__name__ if obj.item.use_function else None
+        item = (strings.add(use_function),)
+
+    equipment = (-1, 0, 0, 0)
+    if obj.equipment:
+        flags |= SAVE_EQUIPMENT
+        e = obj.equipment
+        if e.is_equipped: flags |= SAVE_EQUIPPED
+        equipment = (strings.add(e.slot), e.power_bonus, e.defense_bonus, e.max_hp_bonus)
+
+    return ((obj.x, obj.y, obj.char, strings.add(obj.name), obj.color.r, obj.color.g, obj.color.b, flags,
+        obj.speed, max(0, obj.next_turn - state.game_time), strings.add(obj.label), getattr(obj, 'level', 0))
+        + fighter + ai + item + equipment)
+
+def new_ai(kind):
+    #a monster confused twice is restored straight to its basic AI
+    if kind == SAVE_NO_AI:
+        return None
+    return BasicMonster()
+
+def object_from_record(record, strings):
+    (x, y, char, name, r, g, b, flags, speed, wait, label, level,
+        hp, base_max_hp, base_defense, base_power, xp, death_function, attack_speed,
+        ai, old_ai, confused_turns, use_function, slot, power_bonus, defense_bonus, max_hp_bonus) = record
+
+    fighter = None
+    if flags & SAVE_FIGHTER:
+        fighter = Fighter(hp = base_max_hp, defense = base_defense, power = base_power, xp = xp,
+            death_function = SAVED_FUNCTIONS.get(strings.get(death_function)), attack_speed = attack_speed,
+            god_mode = bool(flags & SAVE_GOD_MODE))
+        fighter.hp = hp
+
+    item = None
+    if flags & SAVE_ITEM and not flags & SAVE_EQUIPMENT:
+        item = Item(use_function = SAVED_FUNCTIONS.get(strings.get(use_function)))
+
+    equipment = None
+    if flags & SAVE_EQUIPMENT:
+        equipment = Equipment(strings.get(slot), power_bonus, defense_bonus, max_hp_bonus)
+        equipment.is_equipped = bool(flags & SAVE_EQUIPPED)
+
+    obj = Object(x, y, char, strings.get(name), libtcod.Color(r, g, b), blocks = bool(flags & SAVE_BLOCKS),
+        always_visible = bool(flags & SAVE_ALWAYS_VISIBLE), fighter = fighter, ai = new_ai(ai), item = item,
+        equipment = equipment, speed = speed)
+    if ai == SAVE_CONFUSED_AI:
+        obj.ai = ConfusedMonster(new_ai(old_ai), confused_turns)
+        obj.ai.owner = obj
+        if obj.ai.old_ai:
+            obj.ai.old_ai.owner = obj
+    obj.wait = wait
+    obj.label = strings.get(label)
+    if flags & SAVE_LEVEL:
+        obj.level = level
+    return obj
+
+def save_game(filename = 'savegame'):
+    #write the game data in the compact format (possibly overwriting an old savegame)
+    strings = StringTable()
+    tile_map = state.map
+    objects = state.objects
+    inventory = state.inventory
+    info = SAVE_INFO.pack(state.dungeon_level, tile_map.width, tile_map.height, objects.index(state.player),
+        objects.index(state.stairs), strings.add(state.game_state))
+    tiles = pack_bits(tile_map.blocked) + pack_bits(tile_map.block_sight) + pack_bits(tile_map.explored)
+    object_records = pack_records([object_record(obj, strings) for obj in objects], SAVE_OBJECT)
+    inventory_records = pack_records([object_record(obj, strings) for obj in inventory], SAVE_OBJECT)
+    messages = pack_records([(strings.add(text), color.r, color.g, color.b) for (text, color) in state.game_msgs], SAVE_MESSAGE)
+    hotkey_records = pack_records([(hot.button, inventory.index(hot.object)) for hot in state.hotkeys
+        if hot.object in inventory], SAVE_HOTKEY)
+
+    write_save_file(filename, [(b'INFO', info), (b'SEED', struct.pack('<q', state.run_seed)), (b'STRS', strings.pack()),
+        (b'TILE', tiles), (b'OBJS', object_records), (b'INVT', inventory_records), (b'MSGS', messages),
+        (b'HKEY', hotkey_records)])
+
+def load_game(filename = 'savegame'):
+    #load the game data, from a compact savegame or an old shelve one
+    if not is_save_file(filename):
+        load_shelve_game(filename)
+        return
+
+    file = SaveFile(filename)
+    strings = file.strings()
+    (state.dungeon_level, width, height, player_index, stairs_index, mode) = SAVE_INFO.unpack(file.section(b'INFO'))
+    state.game_state = strings.get(mode)
+    if b'SEED' in file.directory: #the next levels follow from the seed of the game
+        (seed,) = struct.unpack('<q', file.section(b'SEED'))
+        seed_streams(seed)
+    else:
+        seed_streams(random.randrange(0x80000000))
+
+    tile_map = state.map = TileMap(width, height)
+    plane = (width * height + 7) // 8
+    tiles = file.section(b'TILE')
+    unpack_bits(tiles[:plane], tile_map.blocked)
+    unpack_bits(tiles[plane:2 * plane], tile_map.block_sight)
+    unpack_bits(tiles[2 * plane:], tile_map.explored)
+
+    objects = state.objects = [object_from_record(record, strings) for record in file.records(b'OBJS', SAVE_OBJECT)]
+    state.player = objects[player_index]
+    state.stairs = objects[stairs_index]
+    state.inventory = Inventory(object_from_record(record, strings) for record in file.records(b'INVT', SAVE_OBJECT))
+    state.game_msgs = MessageLog((strings.get(text), libtcod.Color(r, g, b))
+        for (text, r, g, b) in file.records(b'MSGS', SAVE_MESSAGE))
+    state.hotkeys = []
+    for (button, index) in file.records(b'HKEY', SAVE_HOTKEY):
+        Hotkey(button, state.inventory[index]).configure()
     file.close()
 
-def load_game():
-    #open the previously saved shelve and load the game data
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
-
-    file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
-    player = objects[file['player_index']]
-    inventory = file['inventory']
-    game_msgs = file['game_msgs']
-    game_state = file['game_state']
-    stairs = objects[file['stairs_index']]
-    dungeon_level = file['dungeon_level']
+    recompute_all_bonuses()
+    enter_loaded_level()
+
+def load_shelve_game(filename):
+    #open a savegame from before the compact format (a shelve) and load the game data
+    file = shelve.open(filename, 'r')
+    tile_map = file['map']
+    if not isinstance(tile_map, TileMap): #savegame from before the tile arrays
+        tile_map = TileMap.from_tiles(tile_map)
+    state.map = tile_map
+    objects = state.objects = file['objects']
+    for obj in objects: #objects from before the drawing layers
+        obj.layer = object_layer(obj)
+    state.player = objects[file['player_index']]
+    state.inventory = Inventory(file['inventory'])
+    state.game_msgs = MessageLog(file['game_msgs']) #its lines, already wrapped
+    state.game_state = file['game_state']
+    state.stairs = objects[file['stairs_index']]
+    state.dungeon_level = file['dungeon_level']
     file.close()
+    seed_streams(random.randrange(0x80000000))
+
+    state.hotkeys = []
+    recompute_all_bonuses() #fighters from before the cached bonuses have none
+    enter_loaded_level()
+
+def recompute_all_bonuses():
+    #rebuild the cached equipment bonuses of every fighter of a loaded game
+    for obj in state.objects:
+        if obj.fighter:
+            obj.fighter.recompute_bonuses()
+
+def enter_loaded_level():
+    #make the loaded map and objects the current level
+    discard_levels()
+    state.recorder = None #a loaded game can't be played again from its seed
+    state.player.layer = LAYER_PLAYER
+    state.stairs.layer = LAYER_STAIRS
+    level = state.current_level = Level(state.run_seed, state.dungeon_level, state.map, state.objects, state.stairs)
+    state.objects = level.objects
+    level.start = (state.player.x, state.player.y)
+    state.object_index = level.object_index
+    state.dirty_tiles = set()
+
+    #the savegame has how long each object still waits, the game time starts again from 0
+    state.game_time = 0
+    for obj in state.objects:
+        obj.next_turn = obj.wait
+        obj.wait = 0
+        obj.asleep = False
+    schedule_level()
 
     initialize_fov()
+    state.level_cache.prefetch(state.run_seed, state.dungeon_level + 1)
 
 def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level, inventory_dict, hotkeys, hot_chars, hot_types
+    global hot_chars, hot_types
 
     #create object representing the player
     fighter_component = Fighter(hp = 100, defense = 1, power = 2, xp = 0, death_function = player_death)
-    player = Object(0, 0, mage_tile, 'player', libtcod.white, blocks = True, fighter = fighter_component, speed = PLAYER_SPEED)
+    player = state.player = Object(0, 0, mage_tile, 'player', libtcod.white, blocks = True, fighter = fighter_component,
+        speed = PLAYER_SPEED, layer = LAYER_PLAYER)
 
     player.level = 1
     
     #generate map (at this point, not drawn to the screen)
-    dungeon_level = 1
+    state.game_time = 0
+    discard_levels()
+    if game_seed is None:
+        seed_streams(random.randrange(0x80000000))
+    else:
+        seed_streams(game_seed)
+    state.dungeon_level = 1
     make_map()
     initialize_fov()
 
-    game_state = 'playing'
+    state.game_state = 'playing'
 
-    inventory = []
-    inventory_dict = {}
+    state.inventory = Inventory()
     
-    hotkeys = []
+    state.hotkeys = []
     
-    #create the list of game messages and their colors, starts empty
-    game_msgs = []
+    #create the log of game messages and their colors, starts empty
+    state.game_msgs = MessageLog()
 
     message('Welcome, stranger! Try your best not to perish.', libtcod.red)
 
     #intial equipment: a dagger!
     equipment_component = Equipment(slot = 'right hand', power_bonus = 2)
     obj = Object(0, 0, dagger_tile, 'dagger', libtcod.white, equipment = equipment_component)
-    objects.append(obj)
+    add_object(obj)
     obj.item.pick_up()
     obj.always_visible = True
 
-def next_level():
-    global dungeon_level
+    #start generating the next level while the player explores this one
+    state.level_cache.prefetch(state.run_seed, state.dungeon_level + 1)
+
+    #record the inputs from now on
+    state.recorder = None
+    if record_games:
+        state.recorder = Replay(state.run_seed)
 
+def next_level():
     #advance to the next level
+    player = state.player
     if not player.fighter.god_mode:
         message('You take a moment to rest, and recover your strength.', libtcod.light_violet)
         player.fighter.heal(player.fighter.max_hp / 2) #heal the player by 50%
 
-    dungeon_level += 1
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
-    make_map() #create a fresh new level!
-    initialize_fov()
+    change_level(state.dungeon_level + 1) #go to a fresh new level, made in the background!
 
-def initialize_fov():
-    global fov_recompute, fov_map
-    fov_recompute = True
+def initialize_fov(fov = None):
+    state.initialize_fov(fov)
     
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+def set_tile(x, y, blocked, block_sight = None):
+    state.set_tile(x, y, blocked, block_sight)
+
+def use_state(new_state):
+    #make another game the active one, e.g. a new GameState to play a second game in the same process, and
+    #return the game that was active. the screen is repainted for the new game at the next render_all
+    global state
+    old_state = state
+    state = new_state
+    if state.map is not None:
+        state.fov_recompute = True
+        state.redraw_map()
+    return old_state
+
+def set_seed(seed):
+    #play the next games from the given seed, so that they can be reproduced (None for random games again)
+    global game_seed
+    game_seed = seed
+    if seed is not None:
+        seed_streams(seed)
+
+def seed_streams(seed):
+    state.seed_streams(seed)
+
+def end_turn(obj):
+    state.end_turn(obj)
+
+def schedule_level():
+    state.schedule_level()
+
+def wake_up(monster):
+    state.wake_up(monster)
+
+def make_noise(x, y, radius = NOISE_RADIUS):
+    state.make_noise(x, y, radius)
+
+def advance_time(ticks):
+    state.advance_time(ticks)
+
+def frame_ticks():
+    #how many ticks of game time passed since the last frame
+    global clock_time
+    if headless:
+        return input_source.frame_ticks()
+    now = libtcod.sys_elapsed_milli() * TICKS_PER_SECOND
+    ticks = (now - clock_time) // 1000
+    clock_time += ticks * 1000 #the part of a tick left over counts towards the next frame
+    if ticks > MAX_FRAME_TICKS: #don't catch up, e.g. after a menu
+        ticks = MAX_FRAME_TICKS
+        clock_time = now
+    return ticks
+
+def poll_input():
+    #read this frame's key and mouse state, from the input source when headless
+    if headless:
+        input_source.next_key(key)
+    else:
+        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
+    if state.recorder is not None:
+        state.recorder.record_key(key)
 
-    libtcod.console_clear(con) #unexplored areas start black (default background color)
-    
-def play_game():
-    global key, mouse
+def flush_console():
+    #show this frame on the screen
+    if not headless:
+        libtcod.console_flush()
+
+def enable_profiling(overlay = False, filename = PROFILE_FILE):
+    #time the phases of every frame from now on, show their percentiles over the messages if overlay is True,
+    #and dump the times when the program exits (see Profiler)
+    global profiler
+    profiler = Profiler()
+    profiler.overlay = overlay
+    game = sys.modules[__name__]
+    for (name, phase) in [('poll_input', 'input'), ('update_fov', 'fov'), ('draw_tile', 'tiles'),
+            ('fill_map_console', 'tiles'), ('get_panel_state', 'panel'), ('render_panel', 'panel'),
+            ('flush_console', 'flush'), ('handle_keys', 'keys'), ('advance_time', 'ai')]:
+        profiler.instrument(game, name, phase)
+    profiler.instrument(Object, 'draw', 'objects')
+    atexit.register(profiler.dump, filename)
+
+def disable_profiling():
+    global profiler
+    if profiler is not None:
+        profiler.remove()
+        profiler = None
+
+def play_game(max_frames = None):
+    global key, mouse, clock_time
 
     player_action = None
+    frames = 0
+    if not headless:
+        clock_time = libtcod.sys_elapsed_milli() * TICKS_PER_SECOND
 
-    while not libtcod.console_is_window_closed():
-        #render the screen
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
-        render_all()
+    try:
+        while headless or not libtcod.console_is_window_closed():
+            if max_frames is not None and frames >= max_frames:
+                break
+            frames += 1
 
-        libtcod.console_flush()
+            #read input and update the FOV, then render the screen
+            poll_input()
+            update_fov()
+            render_all()
 
-        #level up if needed
-        check_level_up()
-    
-        #erase all objects at their old locations before they move
-        for object in objects:
-            object.clear()
-
-        #handle keys and exit game if needed
-        player_action = handle_keys()
-        if player_action == 'exit':
-            save_game()
-            break
+            flush_console()
 
-        #let monsters take their turn
-        if game_state == 'playing':
-            for object in objects:
-                if object.ai:
-                    if object.wait > 0: #don't take a turn if still waiting
-                        object.wait -= 1
-                    else:
-                        object.ai.take_turn()
+            #level up if needed
+            check_level_up()
+
+            #handle keys and exit game if needed
+            player_action = handle_keys()
+            if player_action == 'exit':
+                if not headless:
+                    save_game()
+                break
+            if state.player.wait > 0: #the player acted
+                end_turn(state.player)
+
+            #let the monsters whose turn came act, and move the game time on
+            ticks = 0
+            if state.game_state == 'playing':
+                ticks = frame_ticks()
+                advance_time(ticks)
+            elif headless: #the game is over, nothing left to simulate
+                break
+
+            if state.recorder is not None:
+                state.recorder.end_frame(ticks)
+            if profiler is not None:
+                profiler.end_frame()
+    finally:
+        #keep the replay of the game, also when it crashed
+        if state.recorder is not None and not headless:
+            state.recorder.save()
+
+    return frames
+
+def run_headless(source, max_frames = None):
+    #play a new game without a window and without a frame cap, driven by an InputSource.
+    #returns a summary of how far the game got
+    global headless, input_source
+    headless = True
+    input_source = source
+
+    new_game()
+    try:
+        frames = play_game(max_frames)
+    except InputExhausted:
+        frames = None
+    return {'game_state': state.game_state, 'dungeon_level': state.dungeon_level, 'player_level': state.player.level,
+        'xp': state.player.fighter.xp, 'hp': state.player.fighter.hp, 'frames': frames}
+
+def run_replay(filename = REPLAY_FILE, max_frames = None):
+    #play a recorded game again, without a window and as fast as possible. returns the summary of
+    #run_headless, and how many seconds it took
+    global game_seed
+    replay = Replay.load(filename)
+    seed = game_seed
+    set_seed(replay.seed)
+    start = timeit.default_timer()
+    try:
+        summary = run_headless(ReplayInput(replay), max_frames)
+    finally:
+        game_seed = seed
+    summary['seconds'] = timeit.default_timer() - start
+    return summary
 
 def main_menu():
     img = libtcod.image_load('nic.png')
@@ -1383,15 +3131,41 @@ def main_menu():
 #      INITIALIZATION AND MAIN LOOP      #
 ##########################################
 
-libtcod.console_set_custom_font('tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "Rogue-Like, the roguelike game", False, libtcod.RENDERER_SDL)
-libtcod.sys_set_fps(LIMIT_FPS)
-libtcod.console_map_ascii_codes_to_font(256, 32, 0, 5)
-libtcod.console_map_ascii_codes_to_font(256+32, 32, 0, 6)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+headless = False #True when there is no window (see run_headless)
+input_source = None #where input comes from when headless
+game_seed = None #the seed of new games, a random one for each game if None (see set_seed)
+clock_time = 0 #real time of the last tick, in milliseconds times TICKS_PER_SECOND (so a tick is exactly 1000)
+fov_maps = FovMaps() #the FOV maps in use and spare ones, shared by all games
+profiler = None #times the phases of each frame when profiling (see enable_profiling)
+record_games = True #record the inputs of every new game, so it can be played again (see Replay)
+state = GameState() #the active game
 
 mouse = libtcod.Mouse()
 key = libtcod.Key()
 
-main_menu()
+def init_console():
+    global con, panel
+    libtcod.console_set_custom_font('tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "Rogue-Like, the roguelike game", False, libtcod.RENDERER_SDL)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    libtcod.console_map_ascii_codes_to_font(256, 32, 0, 5)
+    libtcod.console_map_ascii_codes_to_font(256+32, 32, 0, 6)
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+#other scripts can load this file as a module (e.g. with imp.load_source) and call run_headless()
+if __name__ == '__main__':
+    #--profile times every frame and dumps the times on exit, --profile-overlay also shows them on the panel
+    if '--profile' in sys.argv or '--profile-overlay' in sys.argv:
+        enable_profiling(overlay = '--profile-overlay' in sys.argv)
+        sys.argv = [arg for arg in sys.argv if arg not in ('--profile', '--profile-overlay')]
+    if len(sys.argv) == 3 and sys.argv[1] == '--headless':
+        #play a script of commands, one per line (an empty line is a frame with no key pressed)
+        commands = [line.strip() or None for line in open(sys.argv[2])]
+        print(run_headless(ScriptedInput(commands)))
+    elif len(sys.argv) == 3 and sys.argv[1] == '--replay':
+        #play a recorded game again, as fast as possible
+        print(run_replay(sys.argv[2]))
+    else:
+        init_console()
+        main_menu()
@@ -0,0 +1,99 @@
+#regression checks for rogue-like.py, played headless:
+#
+#   python -m unittest test_rogue_like
+
+import os
+import sys
+import imp
+import shutil
+import shelve
+import tempfile
+import unittest
+
+#libtcodpy loads the library from the current directory, so run from the game's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+game = imp.load_source('roguelike', 'rogue-like.py')
+
+def start_game(commands, seed = 1234):
+    #a new headless game, on a fixed seed and not recorded, reading its input from a list of commands
+    game.headless = True
+    game.record_games = False
+    game.input_source = game.ScriptedInput(commands)
+    game.set_seed(seed)
+    game.new_game()
+    game.update_fov()
+
+class OffMapTargetTest(unittest.TestCase):
+    def test_off_map_tiles_are_not_in_fov(self):
+        start_game([])
+        for (x, y) in [(-1, 0), (0, -1), (game.MAP_WIDTH, 0), (0, game.MAP_HEIGHT),
+                (game.SCREEN_WIDTH - 1, game.SCREEN_HEIGHT - 1)]:
+            self.assertFalse(game.in_fov(x, y))
+        player = game.state.player
+        self.assertTrue(game.in_fov(player.x, player.y))
+
+    def test_click_on_the_panel_cancels_targeting(self):
+        #a left-click below the map, on the panel, while aiming a fireball
+        start_game([(10, game.MAP_HEIGHT + 2)])
+        self.assertEqual(game.target_tile(), (None, None))
+
+class EquipmentBonusTest(unittest.TestCase):
+    def stats(self):
+        fighter = game.state.player.fighter
+        return (fighter.power, fighter.defense, fighter.max_hp)
+
+    def test_stats_are_read_without_walking_the_inventory(self):
+        start_game([])
+        player = game.state.player
+        (power, defense, max_hp) = self.stats()
+        shield = game.Object(player.x, player.y, game.wood_shield_tile, 'shield', game.libtcod.darker_orange,
+            equipment = game.Equipment('left hand', power_bonus = 1, defense_bonus = 2, max_hp_bonus = 5))
+        game.add_object(shield)
+        shield.item.pick_up() #the left hand is free, so the shield is equipped
+        scans = game.state.inventory_scans
+        for i in range(100):
+            self.assertEqual(self.stats(), (power + 1, defense + 2, max_hp + 5))
+        shield.equipment.dequip()
+        for i in range(100):
+            self.assertEqual(self.stats(), (power, defense, max_hp))
+        shield.equipment.equip()
+        for i in range(100):
+            self.assertEqual(self.stats(), (power + 1, defense + 2, max_hp + 5))
+        self.assertEqual(game.state.inventory_scans, scans)
+
+    def test_legacy_save_gets_the_bonuses(self):
+        #a shelve savegame from before the cached bonuses, whose fighters have no bonus totals
+        start_game([])
+        state = game.state
+        for obj in state.objects:
+            if obj.fighter:
+                del obj.fighter.power_bonus, obj.fighter.defense_bonus, obj.fighter.max_hp_bonus
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'savegame')
+            file = shelve.open(filename, 'n')
+            file['map'] = state.map
+            file['objects'] = list(state.objects)
+            file['player_index'] = state.objects.index(state.player)
+            file['inventory'] = list(state.inventory)
+            file['game_msgs'] = list(state.game_msgs)
+            file['game_state'] = state.game_state
+            file['stairs_index'] = state.objects.index(state.stairs)
+            file['dungeon_level'] = state.dungeon_level
+            file.close()
+            game.load_game(filename)
+        finally:
+            shutil.rmtree(directory)
+        monsters = [obj for obj in game.state.objects if obj.fighter and obj is not game.state.player]
+        self.assertTrue(monsters)
+        for monster in monsters:
+            self.assertEqual(monster.fighter.defense, monster.fighter.base_defense)
+        fighter = game.state.player.fighter
+        dagger_bonus = sum(item.equipment.power_bonus for item in game.state.inventory
+            if item.equipment and item.equipment.is_equipped)
+        self.assertEqual(fighter.power, fighter.base_power + dagger_bonus)
+
+if __name__ == '__main__':
+    unittest.main()